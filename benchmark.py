@@ -0,0 +1,782 @@
+"""Benchmarks for the barber shop bot.
+
+Each benchmark runs against a throwaway database in a temporary directory,
+never against barber_shop.db. Usage:
+
+    python benchmark.py pagination [--rows 20000]
+    python benchmark.py availability [--barbers 40] [--days 90]
+    python benchmark.py calendar
+    python benchmark.py webhook [--updates 200]
+    python benchmark.py workers [--updates 1000] [--workers 1 2 4]
+    python benchmark.py load [--clients 2000] [--admins 20]
+    python benchmark.py reminders [--appointments 50000]
+    python benchmark.py export [--rows 20000 100000]
+    python benchmark.py search [--clients 200000]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from datetime import date, datetime, timedelta
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+
+
+def use_temp_database(directory):
+    """Point the bot's helpers at a fresh database inside directory"""
+    bot.db = bot.Database(os.path.join(directory, 'benchmark.db'))
+    bot.init_db()
+
+
+HOURLY_TIMES = [f'{hour}:00' for hour in range(10, 19)]
+
+
+def fill_appointments(rows):
+    """Insert `rows` scheduled appointments, one per hour, starting 2030-01-01"""
+    start = date(2030, 1, 1)
+    slots = len(HOURLY_TIMES)
+    with bot.db.write() as cursor:
+        cursor.executemany(
+            'INSERT INTO clients (user_id, name, phone) VALUES (?, ?, ?)',
+            [(i, f'Client {i}', f'+7900{i:07d}') for i in range(1, 1001)]
+        )
+        cursor.executemany(
+            'INSERT INTO appointments (client_id, service, date, time) VALUES (?, ?, ?, ?)',
+            [
+                (i % 1000 + 1, 'Мужская стрижка',
+                 (start + timedelta(days=i // slots)).isoformat(), HOURLY_TIMES[i % slots])
+                for i in range(rows)
+            ]
+        )
+
+
+def time_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_pagination(args):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        fill_appointments(args.rows)
+
+        # Cursors at the start, middle and end of the table
+        with bot.db.read() as cursor:
+            cursor.execute(
+                "SELECT date, time, id FROM appointments WHERE status = 'scheduled' "
+                "ORDER BY date, time, id LIMIT 1 OFFSET ?", (args.rows // 2,)
+            )
+            middle = cursor.fetchone()
+            cursor.execute(
+                "SELECT date, time, id FROM appointments WHERE status = 'scheduled' "
+                "ORDER BY date DESC, time DESC, id DESC LIMIT 1 OFFSET ?", (bot.BOOKINGS_PAGE_SIZE,)
+            )
+            near_end = cursor.fetchone()
+
+        cases = [
+            ('first page', {}),
+            ('middle, next', {'after': middle}),
+            ('middle, prev', {'before': middle}),
+            ('last page', {'after': near_end}),
+            ('date filter', {'date': middle[0]}),
+        ]
+        print(f"{args.rows} scheduled appointments, page size {bot.BOOKINGS_PAGE_SIZE}")
+        for name, page in cases:
+            def render():
+                rows, has_prev, has_next = bot.get_appointments_page(**page)
+                bot.render_bookings_page(rows, has_prev, has_next, page.get('date'))
+            print(f"  {name:<14} {time_call(render, args.repeat) * 1e6:8.1f} us/page")
+        bot.db.close()
+
+
+def bench_availability(args):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        bot.BARBERS = [(f'Мастер {i}', '09:00' if i % 2 else '12:00', '18:00' if i % 2 else '21:00')
+                       for i in range(args.barbers)]
+        bot.load_barbers()
+
+        # Book a random ~70% of every barber's day for `days` days
+        first = date(2030, 1, 1)
+        dates = [(first + timedelta(days=i)).isoformat() for i in range(args.days)]
+        services = list(bot.SERVICES)
+        random.seed(1)
+        booked = 0
+        for day in dates:
+            for _ in range(args.barbers * 7):
+                service = random.choice(services)
+                times = bot.slot_index.free_times(day, bot.service_duration(service))
+                if times:
+                    appointment_id, _ = bot.save_appointment(1, service, day, random.choice(times))
+                    booked += appointment_id is not None
+        with bot.db.read() as cursor:
+            cursor.execute('SELECT barber_id, date, cell FROM appointment_slots')
+            start = time.perf_counter()
+            bot.slot_index.warm(cursor.fetchall())
+            warm = time.perf_counter() - start
+
+        print(f"{args.barbers} barbers, {args.days} days, {booked} appointments "
+              f"(index warmed in {warm * 1e3:.1f} ms)")
+        for service in services:
+            duration = bot.service_duration(service)
+            lookup = time_call(lambda: bot.slot_index.free_times(random.choice(dates), duration), args.repeat)
+            keyboard = time_call(lambda: bot.keyboards.time_keyboard(random.choice(dates), service), args.repeat)
+            print(f"  {duration:>3} min: free start times {lookup * 1e6:7.1f} us, time keyboard {keyboard * 1e6:7.1f} us")
+        # Date keyboard over every working day, as choose_service builds it
+        with bot.db.write() as cursor:
+            cursor.executemany(bot.SQL_ADD_WORKING_DAY, [(day,) for day in dates])
+        bot.reload_working_days()
+        for service in services:
+            keyboard = time_call(lambda: bot.keyboards.date_keyboard(service), max(args.repeat // 50, 1))
+            print(f"  {bot.service_duration(service):>3} min: date keyboard over {len(dates)} days {keyboard * 1e6:9.1f} us")
+        bot.db.close()
+
+
+def bench_calendar(args):
+    today = datetime.now().date()
+    months = [((today.month - 1 + i) // 12 + today.year, (today.month - 1 + i) % 12 + 1)
+              for i in range(12)]
+
+    def navigate(build):
+        for year, month in months:
+            build(year, month)
+
+    uncached = lambda year, month: bot._calendar_markup.__wrapped__(year, month, today)
+    bot._calendar_markup.cache_clear()
+    navigate(bot.generate_calendar_markup)  # warm
+    print("12 months of calendar navigation")
+    print(f"  uncached {time_call(lambda: navigate(uncached), args.repeat) * 1e6 / 12:8.1f} us/month")
+    print(f"  cached   {time_call(lambda: navigate(bot.generate_calendar_markup), args.repeat) * 1e6 / 12:8.1f} us/month")
+    print(f"  {bot._calendar_markup.cache_info()}")
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # the bot opens up to MAX_CONCURRENT_UPDATES connections at once
+
+    def handle_error(self, request, client_address):
+        pass  # the bot drops its long poll connection when it stops
+
+
+class FakeTelegram:
+    """Minimal in-process Bot API server.
+
+    Queues updates for getUpdates long polling, records setWebhook and
+    timestamps every sendMessage so reply latency can be measured.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.condition = threading.Condition()
+        self.webhook = None
+        self.polling = threading.Event()
+        self.replies = {}  # chat_id -> threading.Event set on sendMessage
+        self.server = FakeTelegramServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}/bot"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+
+    def push_update(self, update):
+        with self.condition:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def expect_reply(self, chat_id):
+        event = self.replies[chat_id] = threading.Event()
+        return event
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if method == 'setWebhook':
+            self.webhook = params
+        elif method == 'getUpdates':
+            self.polling.set()
+            offset = int(params.get('offset', 0))
+            deadline = time.monotonic() + float(params.get('timeout', 0))
+            with self.condition:
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+                while not self.updates and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                return list(self.updates)
+        elif method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            event = self.replies.get(chat_id)
+            if event:
+                event.set()
+            return {'message_id': 1, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': chat_id, 'type': 'private'}}
+        return True
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                result = fake.call(self.path.rsplit('/', 1)[-1], params)
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def start_update(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+            'chat': {'id': user_id, 'type': 'private'}, 'from': user,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def post_webhook(url, secret, update):
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method='POST',
+        headers={'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except urllib.error.URLError:
+        return None  # server not listening yet
+
+
+def start_bot(fake, mode, database, **extra_env):
+    """Start bot.py as a subprocess in `mode` and wait until it takes updates.
+
+    Returns the process and its environment."""
+    port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN='123:benchmark',
+        TELEGRAM_API_URL=fake.url,
+        BARBER_DB_PATH=database,
+        BOT_MODE=mode,
+        WEBHOOK_URL=f'http://127.0.0.1:{port}/telegram',
+        WEBHOOK_LISTEN='127.0.0.1',
+        WEBHOOK_PORT=str(port),
+        WEBHOOK_SECRET='benchmark-secret',
+        **extra_env
+    )
+    fake.polling.clear()
+    fake.webhook = None
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + 30
+        if mode == 'webhook':
+            while post_webhook(env['WEBHOOK_URL'], 'wrong', {'update_id': 0}) != 403:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("webhook server did not start")
+                time.sleep(0.1)
+        elif not fake.polling.wait(30):
+            raise RuntimeError("bot did not start polling")
+    except BaseException:
+        stop_bot(process)
+        raise
+    return process, env
+
+
+def stop_bot(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_bot_against(fake, mode, directory, updates):
+    """Start bot.py in `mode`, send /start from `updates` distinct users one
+    after another and return the reply latencies"""
+    process, env = start_bot(fake, mode, os.path.join(directory, f'{mode}.db'))
+    try:
+        if mode == 'webhook':
+            print(f"  webhook registered with secret: {fake.webhook.get('secret_token') == 'benchmark-secret'}, "
+                  f"wrong secret rejected with 403")
+        latencies = []
+        for i in range(updates):
+            user_id = 100000 + i
+            replied = fake.expect_reply(user_id)
+            start = time.perf_counter()
+            if mode == 'webhook':
+                post_webhook(env['WEBHOOK_URL'], env['WEBHOOK_SECRET'], start_update(i + 1, user_id))
+            else:
+                fake.push_update(start_update(0, user_id))
+            if not replied.wait(10):
+                raise RuntimeError(f"no reply to update {i}")
+            latencies.append(time.perf_counter() - start)
+        return latencies
+    finally:
+        stop_bot(process)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_webhook(args):
+    fake = FakeTelegram()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            print(f"/start round trip through a local fake Bot API, {args.updates} updates per mode")
+            for mode in ('polling', 'webhook'):
+                print(f"{mode}:")
+                latencies = run_bot_against(fake, mode, directory, args.updates)
+                print(f"  p50 {percentile(latencies, 0.5) * 1e3:6.2f} ms  "
+                      f"p95 {percentile(latencies, 0.95) * 1e3:6.2f} ms  "
+                      f"mean {statistics.mean(latencies) * 1e3:6.2f} ms")
+    finally:
+        fake.close()
+
+
+def bench_workers(args):
+    fake = FakeTelegram()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            print(f"{args.updates} /start updates from distinct users queued at once, "
+                  f"{os.cpu_count()} CPU(s) available")
+            for workers in args.workers:
+                process, _ = start_bot(fake, 'polling', os.path.join(directory, f'workers-{workers}.db'),
+                                       BOT_WORKERS=str(workers))
+                try:
+                    # Warm up every worker so process start-up is not measured
+                    for user_id in range(workers):
+                        replied = fake.expect_reply(user_id + 1)
+                        fake.push_update(start_update(0, user_id + 1))
+                        if not replied.wait(30):
+                            raise RuntimeError("worker did not start")
+
+                    users = range(200000, 200000 + args.updates)
+                    replies = [fake.expect_reply(user_id) for user_id in users]
+                    start = time.perf_counter()
+                    for user_id in users:
+                        fake.push_update(start_update(0, user_id))
+                    for replied in replies:
+                        if not replied.wait(60):
+                            raise RuntimeError("not all updates were answered")
+                    elapsed = time.perf_counter() - start
+                finally:
+                    stop_bot(process)
+                print(f"  {workers} worker(s): {args.updates / elapsed:8.1f} updates/s")
+    finally:
+        fake.close()
+
+
+class TracedDatabase(bot.Database):
+    """Database counting every SQL statement run on any of its connections"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.statements = 0
+        self._statements_lock = threading.Lock()
+
+    def _connect(self):
+        connection = super()._connect()
+        connection.set_trace_callback(self._count)
+        return connection
+
+    def _count(self, statement):
+        with self._statements_lock:
+            self.statements += 1
+
+
+class FakeBotRequest(BaseRequest):
+    """In-process Bot API: answers every call and remembers the last message
+    and reply keyboard sent to each chat"""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.last_text = {}
+        self.last_markup = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        params = request_data.parameters if request_data else {}
+        name = url.rsplit('/', 1)[-1]
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif name in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            self.last_text[chat_id] = params.get('text', '')
+            self.last_markup[chat_id] = params.get('reply_markup')
+            result = {'message_id': next(self.message_ids), 'date': 0, 'text': params.get('text', ''),
+                      'chat': {'id': chat_id, 'type': 'private'}}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def buttons(self, chat_id):
+        """Texts of the reply keyboard and callback data of the inline keyboard
+        last shown to chat_id"""
+        markup = self.last_markup.get(chat_id) or {}
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        rows = markup.get('keyboard', []) + markup.get('inline_keyboard', [])
+        return [button if isinstance(button, str) else button.get('text' if 'keyboard' in markup else 'callback_data')
+                for row in rows for button in row]
+
+
+class LoadSimulator:
+    """Drives the bot's real Application with generated updates, as if
+    Telegram delivered them, and times every conversation handler"""
+
+    def __init__(self, application, request):
+        self.application = application
+        self.request = request
+        self.update_ids = itertools.count(1)
+        self.handler_latencies = defaultdict(list)
+        self.update_latencies = []
+        conversation = next(handler for handler in application.handlers[0]
+                            if isinstance(handler, bot.ConversationHandler))
+        handlers = list(conversation.entry_points) + list(conversation.fallbacks)
+        for state_handlers in conversation.states.values():
+            handlers.extend(state_handlers)
+        for handler in handlers:
+            handler.callback = self._timed(handler.callback)
+
+    def _timed(self, callback):
+        if getattr(callback, 'timed', False):
+            return callback
+
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.handler_latencies[callback.__name__].append(time.perf_counter() - start)
+        timed.timed = True
+        return timed
+
+    def update(self, user_id, first_name, text=None, contact=None, callback_data=None):
+        update_id = next(self.update_ids)
+        user = {'id': user_id, 'is_bot': False, 'first_name': first_name}
+        chat = {'id': user_id, 'type': 'private'}
+        if callback_data is not None:
+            return {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': callback_data,
+                'message': {'message_id': update_id, 'date': 0, 'chat': chat, 'text': ''}}}
+        message = {'message_id': update_id, 'date': 0, 'chat': chat, 'from': user}
+        if contact:
+            message['contact'] = {'phone_number': contact, 'first_name': first_name, 'user_id': user_id}
+        else:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': update_id, 'message': message}
+
+    async def send(self, *args, **kwargs):
+        """Process one update the way Application does for fetched updates"""
+        update = Update.de_json(self.update(*args, **kwargs), self.application.bot)
+        start = time.perf_counter()
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update))
+        self.update_latencies.append(time.perf_counter() - start)
+
+    async def client(self, user_id):
+        """Book a slot on one of the offered dates; on a lost race pick another
+        offered time. Returns whether the booking succeeded"""
+        name = f'Client {user_id}'
+        await self.send(user_id, name, '/start')
+        await self.send(user_id, name, contact=f'+7900{user_id:07d}')
+        await self.send(user_id, name, random.choice(list(bot.SERVICES)))
+        dates = [text for text in self.request.buttons(user_id) if text != '❌ Отмена']
+        if not dates:
+            return False
+        await self.send(user_id, name, random.choice(dates))
+        while True:
+            times = [text for text in self.request.buttons(user_id) if text in bot.CELL_OF_TIME]
+            if not times:
+                return False
+            await self.send(user_id, name, random.choice(times))
+            await self.send(user_id, name, '✅ Подтвердить')
+            if self.request.last_text[user_id].startswith('✅'):
+                return True
+
+    async def admin(self, user_id, phone, pages):
+        name = f'Admin {user_id}'
+        await self.send(user_id, name, '/start')
+        await self.send(user_id, name, contact=phone)
+        await self.send(user_id, name, '📋 Просмотр записей')
+        for _ in range(pages):
+            next_page = [data for data in self.request.buttons(user_id) if data and data.startswith('bk|next|')]
+            if not next_page:
+                break
+            await self.send(user_id, name, callback_data=next_page[0])
+        await self.send(user_id, name, '🔙 Назад в меню админа')
+
+
+def bench_load(args):
+    with tempfile.TemporaryDirectory() as directory:
+        bot.db = TracedDatabase(os.path.join(directory, 'load.db'))
+        bot.init_db()
+        # Room for every client with some contention for popular slots
+        days = -(-args.clients // 4) + 1
+        dates = [(date(2030, 1, 1) + timedelta(days=i)).isoformat() for i in range(days)]
+        with bot.db.write() as cursor:
+            cursor.executemany(bot.SQL_ADD_WORKING_DAY, [(day,) for day in dates])
+        admin_phones = [f'+7999{i:07d}' for i in range(args.admins)]
+        bot.ADMIN_PHONES = bot.ADMIN_PHONES + admin_phones
+        bot.warm_caches()
+
+        request = FakeBotRequest()
+        application = bot.build_application(with_updater=False, request=request)
+        simulator = LoadSimulator(application, request)
+
+        async def run():
+            async with application:
+                await application.start()
+
+                # One booking on its own, to count its statements
+                before = bot.db.statements
+                await simulator.client(1)
+                await application.update_persistence()
+                await application.persistence.flush()
+                single = bot.db.statements - before
+                simulator.handler_latencies.clear()
+                simulator.update_latencies.clear()
+
+                before = bot.db.statements
+                start = time.perf_counter()
+                flows = [simulator.client(user_id) for user_id in range(2, args.clients + 2)]
+                flows += [simulator.admin(10 ** 9 + i, phone, args.pages) for i, phone in enumerate(admin_phones)]
+                results = await asyncio.gather(*flows)
+                elapsed = time.perf_counter() - start
+                await application.update_persistence()
+                await application.persistence.flush()
+                statements = bot.db.statements - before
+                await application.stop()
+            return single, results[:args.clients], elapsed, statements
+
+        single, booked, elapsed, statements = asyncio.run(run())
+        bookings = sum(booked)
+
+        print(f"{args.clients} clients and {args.admins} admins at once, {days} working days")
+        print(f"  {len(simulator.update_latencies)} updates in {elapsed:.2f} s: "
+              f"{len(simulator.update_latencies) / elapsed:8.1f} updates/s, {bookings} bookings")
+        print(f"  DB statements: {single} for a single booking, "
+              f"{statements / max(bookings, 1):.1f} per booking under load (incl. admin traffic)")
+        print(f"  {'handler':<22}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        rows = sorted(simulator.handler_latencies.items()) + [('whole update', simulator.update_latencies)]
+        for name, latencies in rows:
+            print(f"  {name:<22}{len(latencies):>7}" + ''.join(
+                f"{percentile(latencies, fraction) * 1e3:9.2f}" for fraction in (0.5, 0.95, 0.99)))
+        bot.db.close()
+
+
+def bench_reminders(args):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        # Upcoming appointments spread over the next `days` days, one per hour
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
+        with bot.db.write() as cursor:
+            cursor.execute("INSERT INTO clients (user_id, name, phone) VALUES (1, 'Client', '+79000000000')")
+            cursor.executemany(
+                'INSERT INTO appointments (client_id, service, date, time, barber_id, duration) VALUES (1, ?, ?, ?, 1, 60)',
+                [('Мужская стрижка', (now + timedelta(minutes=30 * i)).strftime('%Y-%m-%d'),
+                  (now + timedelta(minutes=30 * i)).strftime('%H:%M')) for i in range(1, args.appointments + 1)]
+            )
+        scheduler = bot.ReminderScheduler()
+
+        async def run():
+            start = time.perf_counter()
+            await scheduler.refill()
+            load = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                await scheduler.refill()
+            poll = (time.perf_counter() - start) / args.repeat
+            return load, poll
+
+        load, poll = asyncio.run(run())
+        def scan_all():
+            with bot.db.read() as cursor:
+                cursor.execute("SELECT id, date, time FROM appointments "
+                               "WHERE status = 'scheduled' AND reminder_sent_at IS NULL")
+                cursor.fetchall()
+        full_scan = time_call(scan_all, 20)
+        print(f"{args.appointments} upcoming appointments, {len(scheduler)} reminders held in memory")
+        print(f"  window load             {load * 1e3:8.2f} ms")
+        print(f"  catch-up poll           {poll * 1e6:8.1f} us")
+        print(f"  full table poll (naive) {full_scan * 1e3:8.2f} ms")
+        bot.db.close()
+
+
+def bench_export(args):
+    print("rows       format   seconds  file KiB  peak Python memory KiB")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            use_temp_database(directory)
+            fill_appointments(rows)
+            bot.load_barbers()
+            for fmt in ('csv', 'json'):
+                with tempfile.TemporaryFile() as export_file:
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    bot.write_export(export_file, '', '9999-12-31', fmt)
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    print(f"{rows:<10} {fmt:<6} {elapsed:9.2f} {export_file.tell() / 1024:9.0f} {peak / 1024:12.0f}")
+            bot.db.close()
+
+
+FIRST_NAMES = ['Иван', 'Пётр', 'Анна', 'Мария', 'Олег', 'Елена', 'Дмитрий', 'Ольга', 'Сергей', 'Наталья']
+LAST_NAMES = ['Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов', 'Попов', 'Соколов', 'Лебедев',
+              'Козлов', 'Новиков', 'Морозов', 'Волков', 'Соловьёв', 'Васильев', 'Зайцев', 'Павлов']
+
+
+def bench_search(args):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        bot.load_barbers()
+        random.seed(1)
+        first = date(2030, 1, 1)
+        with bot.db.write() as cursor:
+            cursor.executemany(
+                'INSERT INTO clients (user_id, name, phone) VALUES (?, ?, ?)',
+                [(i, f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {i}', f'+7900{i:07d}')
+                 for i in range(1, args.clients + 1)]
+            )
+            # One appointment per client, a third of them still scheduled
+            cursor.executemany(
+                'INSERT INTO appointments (client_id, service, date, time, barber_id, duration, status) '
+                'VALUES (?, ?, ?, ?, 1, 60, ?)',
+                [(i, 'Мужская стрижка', (first + timedelta(days=i % 365)).isoformat(), HOURLY_TIMES[i % 9],
+                  'scheduled' if i % 3 == 0 else 'completed') for i in range(1, args.clients + 1)]
+            )
+
+        def like_scan(text):
+            with bot.db.read() as cursor:
+                cursor.execute(
+                    "SELECT a.id FROM clients c JOIN appointments a ON a.client_id = c.id "
+                    "WHERE a.status = 'scheduled' AND (c.name LIKE ? OR c.phone LIKE ?) "
+                    "ORDER BY a.date, a.time LIMIT ?", (f'%{text}%', f'%{text}%', bot.SEARCH_LIMIT))
+                cursor.fetchall()
+
+        print(f"{args.clients} clients and appointments")
+        for text in (f'Зайцев {args.clients // 2}', str(args.clients // 3 * 10 + 3)[-5:], 'Соловьёв', '7900'):
+            search = time_call(lambda: bot.search_appointments(text), args.repeat)
+            scan = time_call(lambda: like_scan(text), max(args.repeat // 20, 1))
+            print(f"  {text!r:<24} index {search * 1e3:7.2f} ms   LIKE scan {scan * 1e3:7.2f} ms")
+        bot.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pagination = subparsers.add_parser('pagination', help='admin bookings page fetch + render')
+    pagination.add_argument('--rows', type=int, default=20000)
+    pagination.add_argument('--repeat', type=int, default=500)
+    pagination.set_defaults(func=bench_pagination)
+
+    availability = subparsers.add_parser('availability', help='free start times across many barbers')
+    availability.add_argument('--barbers', type=int, default=40)
+    availability.add_argument('--days', type=int, default=90)
+    availability.add_argument('--repeat', type=int, default=5000)
+    availability.set_defaults(func=bench_availability)
+
+    calendar = subparsers.add_parser('calendar', help='admin calendar keyboard generation')
+    calendar.add_argument('--repeat', type=int, default=500)
+    calendar.set_defaults(func=bench_calendar)
+
+    webhook = subparsers.add_parser('webhook', help='polling vs webhook latency against a fake Bot API')
+    webhook.add_argument('--updates', type=int, default=200)
+    webhook.set_defaults(func=bench_webhook)
+
+    workers = subparsers.add_parser('workers', help='throughput with BOT_WORKERS worker processes')
+    workers.add_argument('--updates', type=int, default=1000)
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.set_defaults(func=bench_workers)
+
+    load = subparsers.add_parser('load', help='full booking conversations from many concurrent users')
+    load.add_argument('--clients', type=int, default=2000)
+    load.add_argument('--admins', type=int, default=20)
+    load.add_argument('--pages', type=int, default=3, help='bookings pages each admin flips through')
+    load.set_defaults(func=bench_load)
+
+    reminders = subparsers.add_parser('reminders', help='reminder window load and poll cost')
+    reminders.add_argument('--appointments', type=int, default=50000)
+    reminders.add_argument('--repeat', type=int, default=200)
+    reminders.set_defaults(func=bench_reminders)
+
+    export = subparsers.add_parser('export', help='gzipped CSV/JSON export time and memory')
+    export.add_argument('--rows', type=int, nargs='+', default=[20000, 100000])
+    export.set_defaults(func=bench_export)
+
+    search = subparsers.add_parser('search', help='admin client search, trigram index vs LIKE scan')
+    search.add_argument('--clients', type=int, default=200000)
+    search.add_argument('--repeat', type=int, default=100)
+    search.set_defaults(func=bench_search)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,32 @@
+import asyncio
+import bisect
+import csv
+import functools
+import gzip
+import heapq
+import io
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import re
+import secrets
+import signal
 import sqlite3
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext, CallbackQueryHandler
+from telegram.ext import BasePersistence, BaseUpdateProcessor, PersistenceInput, TypeHandler
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 # Enable logging
@@ -12,12 +36,33 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Bot settings, overridable from the environment
+BOT_TOKEN = os.environ.get('BOT_TOKEN', "7776578154:AAFzZDiIi2yhPVjqNv-7od85ve-UJ1S4ZRU")
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')  # e.g. http://127.0.0.1:8081/bot for a local Bot API server
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # public URL Telegram posts updates to
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it are
+# rejected with 403. A random one is registered on every start if unset.
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# Prometheus metrics endpoint, off unless a port is given. With BOT_WORKERS > 1
+# worker N serves on METRICS_PORT + N + 1.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+
 # Define conversation states
 (START, CHOOSE_SERVICE, CHOOSE_DATE, CHOOSE_TIME, PROVIDE_CONTACT, CONFIRM_BOOKING, 
- ADMIN_MENU, ADMIN_VIEW_BOOKINGS, ADMIN_ADD_DATES, ADMIN_REMOVE_DATES) = range(10)
+ ADMIN_MENU, ADMIN_VIEW_BOOKINGS, ADMIN_ADD_DATES, ADMIN_REMOVE_DATES, ADMIN_EXPORT) = range(11)
+STATE_NAMES = ('START', 'CHOOSE_SERVICE', 'CHOOSE_DATE', 'CHOOSE_TIME', 'PROVIDE_CONTACT', 'CONFIRM_BOOKING',
+               'ADMIN_MENU', 'ADMIN_VIEW_BOOKINGS', 'ADMIN_ADD_DATES', 'ADMIN_REMOVE_DATES', 'ADMIN_EXPORT')
 
 # Admin phone number for authentication
 ADMIN_PHONE = '+79252083325'  # Replace this with your actual admin phone number when needed
+# All admin phone numbers; seeded into the admins table at startup. Admins
+# added directly to the table are picked up too.
+ADMIN_PHONES = [ADMIN_PHONE]
 
 # Service types with emojis
 SERVICES = {
@@ -26,171 +71,2224 @@ SERVICES = {
     '👦 Детская стрижка': 'Children\'s Haircut',
     '🎨 Окрашивание': 'Hair Coloring'
 }
+# How long each service takes, in minutes (a multiple of SLOT_MINUTES)
+SERVICE_DURATIONS = {
+    '💇‍♂️ Мужская стрижка': 60,
+    '💇‍♀️ Женская стрижка': 90,
+    '👦 Детская стрижка': 30,
+    '🎨 Окрашивание': 120
+}
+DEFAULT_DURATION = 60  # appointments booked before durations existed
+
+# Barbers and their daily working hours (name, from, until); seeded into the
+# barbers table at startup. Barbers added directly to the table are picked up too.
+BARBERS = [('Мастер', '10:00', '19:00')]
+
+# Database settings
+DB_PATH = os.environ.get('BARBER_DB_PATH', 'barber_shop.db')
+DB_READERS = 4  # size of the reader connection pool
+
+class Database:
+    """Long-lived SQLite connections shared by all helpers.
+
+    Writes go through a single writer connection serialized by a lock, reads
+    borrow a connection from a small pool. WAL mode lets readers run alongside
+    the writer, and because connections live for the whole process their
+    prepared statement caches are reused between updates.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._write_depth = 0  # write() blocks open on the writer, nested ones included
+        self._readers = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(readers)
+        self._all_connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        # isolation_level=None: transactions are opened explicitly in write()
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA cache_size = -8000')  # 8 MB page cache per connection
+        conn.execute('PRAGMA temp_store = MEMORY')
+        with self._connections_lock:
+            self._all_connections.append(conn)
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Yield a cursor on a pooled reader connection"""
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn.cursor()
+            finally:
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    @contextmanager
+    def write(self):
+        """Yield a cursor on the writer connection inside a transaction. A
+        write() nested in another joins the outer transaction."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            self._write_depth += 1
+            try:
+                if self._write_depth > 1:
+                    yield conn.cursor()
+                    return
+                conn.execute('BEGIN IMMEDIATE')
+                cursor = conn.cursor()
+                try:
+                    yield cursor
+                    conn.execute('COMMIT')
+                except BaseException:
+                    # Also after a failed COMMIT, which leaves the transaction
+                    # open; the cursor's unfinished statement would make the
+                    # next COMMIT fail as well
+                    cursor.close()
+                    if conn.in_transaction:
+                        conn.execute('ROLLBACK')
+                    raise
+            finally:
+                self._write_depth -= 1
+
+    def data_version(self):
+        """A value that changes whenever another connection, e.g. another
+        worker process, has committed to the database"""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            return self._writer.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        with self._write_lock, self._connections_lock:
+            for conn in self._all_connections:
+                conn.close()
+            self._all_connections.clear()
+            self._writer = None
+            self._readers = queue.LifoQueue()
+
+db = Database(DB_PATH)
+
+# Blocking helpers run here so disk I/O and lock waits never stall the event loop.
+# Writes get a thread of their own: they are serialized by the writer lock
+# anyway, and writes queued behind a long transaction must not take up the
+# threads reads run on.
+db_executor = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix='db')
+db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+
+def writes(func):
+    """Mark a helper that writes, so run_db runs it on the writer thread"""
+    func.writes = True
+    return func
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper in the DB thread pool and await its result"""
+    loop = asyncio.get_running_loop()
+    executor = db_write_executor if getattr(func, 'writes', False) else db_executor
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+# Metrics. Observations are a lock plus a few list operations, cheap enough to
+# record on every handler call and query; /metrics renders them on demand.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                label_text = format_labels(self.label_names + ('le',), labels + (str(bound),))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {values[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+HANDLER_LATENCY = Histogram('bot_handler_duration_seconds', 'Time spent in a conversation handler.', ('state', 'handler'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Conversation handlers that raised.', ('state', 'handler'))
+QUERY_LATENCY = Histogram('bot_db_query_duration_seconds', 'Time spent in a database helper.', ('query',))
+QUERY_ERRORS = Counter('bot_db_query_errors_total', 'Database helpers that raised.', ('query',))
+ARCHIVED_ROWS = Counter('bot_archived_rows_total', 'Rows moved to the archive tables.', ('table',))
+
+# Conversations that have started and not yet ended, keyed like ConversationHandler
+active_conversations = set()
+
+def render_metrics():
+    lines = []
+    for metric in (HANDLER_LATENCY, HANDLER_ERRORS, QUERY_LATENCY, QUERY_ERRORS, ARCHIVED_ROWS):
+        lines.extend(metric.render())
+    lines.append("# HELP bot_conversations_in_flight Conversations started and not yet finished.")
+    lines.append("# TYPE bot_conversations_in_flight gauge")
+    lines.append(f"bot_conversations_in_flight {len(active_conversations)}")
+    return '\n'.join(lines) + '\n'
+
+def timed_query(func):
+    """Record latency and errors of a blocking database helper"""
+    labels = (func.__name__,)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            QUERY_ERRORS.inc(labels)
+            raise
+        finally:
+            QUERY_LATENCY.observe(labels, perf_counter() - start)
+    return wrapper
+
+def timed_handler(state, callback):
+    """Wrap a conversation callback to record its latency and errors and
+    keep track of the conversations in flight"""
+    labels = (state, callback.__name__)
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = perf_counter()
+        try:
+            next_state = await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(labels)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(labels, perf_counter() - start)
+        key = (update.effective_chat.id, update.effective_user.id)
+        if next_state == ConversationHandler.END:
+            active_conversations.discard(key)
+        elif next_state is not None:
+            active_conversations.add(key)
+        return next_state
+    return wrapper
+
+def instrument_conversation(conv_handler):
+    for handler in conv_handler.entry_points:
+        handler.callback = timed_handler('ENTRY', handler.callback)
+    for state, handlers in conv_handler.states.items():
+        for handler in handlers:
+            handler.callback = timed_handler(STATE_NAMES[state], handler.callback)
+    for handler in conv_handler.fallbacks:
+        handler.callback = timed_handler('FALLBACK', handler.callback)
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the log
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer((METRICS_LISTEN, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{METRICS_LISTEN}:{port}/metrics")
+    return server
 
 # Database initialization
 def init_db():
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    # Create clients table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS clients (
-        id INTEGER PRIMARY KEY,
-        user_id INTEGER UNIQUE,
-        name TEXT,
-        phone TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Create appointments table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS appointments (
-        id INTEGER PRIMARY KEY,
-        client_id INTEGER,
-        service TEXT,
-        date TEXT,
-        time TEXT,
-        status TEXT DEFAULT 'scheduled',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (client_id) REFERENCES clients (id)
-    )
-    ''')
-    
-    # Create working_days table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS working_days (
-        id INTEGER PRIMARY KEY,
-        date TEXT UNIQUE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with db.write() as cursor:
+        # Create clients table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER UNIQUE,
+            name TEXT,
+            phone TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Create appointments table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments (
+            id INTEGER PRIMARY KEY,
+            client_id INTEGER,
+            service TEXT,
+            date TEXT,
+            time TEXT,
+            status TEXT DEFAULT 'scheduled',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (client_id) REFERENCES clients (id)
+        )
+        ''')
+        
+        # Create working_days table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS working_days (
+            id INTEGER PRIMARY KEY,
+            date TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(appointments)')}
+        if 'barber_id' not in columns:
+            cursor.execute('ALTER TABLE appointments ADD COLUMN barber_id INTEGER REFERENCES barbers (id)')
+        if 'duration' not in columns:
+            cursor.execute('ALTER TABLE appointments ADD COLUMN duration INTEGER')
+        if 'reminder_sent_at' not in columns:
+            cursor.execute('ALTER TABLE appointments ADD COLUMN reminder_sent_at TIMESTAMP')
+        
+        # Create barbers table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS barbers (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            day_start TEXT NOT NULL,
+            day_end TEXT NOT NULL
+        )
+        ''')
+        
+        # One row per barber per SLOT_MINUTES cell of every scheduled
+        # appointment. The primary key is what makes a double booking
+        # impossible, whatever the appointment's length.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointment_slots (
+            date TEXT NOT NULL,
+            barber_id INTEGER NOT NULL,
+            cell INTEGER NOT NULL,
+            appointment_id INTEGER NOT NULL,
+            PRIMARY KEY (date, barber_id, cell)
+        ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointment_slots_appointment
+        ON appointment_slots (appointment_id)
+        ''')
+        
+        # Indexes for the hot queries. The partial index only covers scheduled
+        # appointments, so completed history does not slow down the bookings
+        # view. Several barbers may share a time, so it is no longer unique.
+        cursor.execute('DROP INDEX IF EXISTS ux_appointments_slot')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_scheduled
+        ON appointments (date, time) WHERE status = 'scheduled'
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clients_phone ON clients (phone)')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_client
+        ON appointments (client_id, date, time) WHERE status = 'scheduled'
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (date)')
+        # Only appointments still waiting for their reminder, so the scheduler's
+        # window query stays a short range seek however long the history is
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_reminders
+        ON appointments (date, time) WHERE status = 'scheduled' AND reminder_sent_at IS NULL
+        ''')
+        
+        # Archive tables: rows moved out of the hot tables by archive_old_rows().
+        # Archived appointments get ids of the archive's own and keep their
+        # original id in appointment_id.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS appointments_archive (
+            id INTEGER PRIMARY KEY,
+            appointment_id INTEGER,
+            client_id INTEGER,
+            service TEXT,
+            date TEXT,
+            time TEXT,
+            status TEXT,
+            barber_id INTEGER,
+            duration INTEGER,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_appointments_archive_date
+        ON appointments_archive (date)
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS working_days_archive (
+            id INTEGER PRIMARY KEY,
+            date TEXT,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Create outbox table: messages waiting to be delivered by OutboxDispatcher
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        # Replaced by idx_outbox_chat: the dispatcher walks chats, not due times
+        cursor.execute('DROP INDEX IF EXISTS idx_outbox_pending')
+        # Each chat's queue, oldest first, for picking its next message
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_chat
+        ON outbox (chat_id, id) WHERE status = 'pending'
+        ''')
+        
+        # Persisted conversation state, written by SQLitePersistence
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, key)
+        )
+        ''')
+        
+        # Create admins table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            phone TEXT PRIMARY KEY,
+            user_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # Booking counters per date, service and status, kept current by the
+        # booking helpers in the same transaction as the appointment change.
+        # They are never archived, so reports cover the whole history.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS booking_stats (
+            date TEXT NOT NULL,
+            service TEXT NOT NULL,
+            status TEXT NOT NULL,
+            bookings INTEGER NOT NULL,
+            minutes INTEGER NOT NULL,
+            PRIMARY KEY (date, service, status)
+        ) WITHOUT ROWID
+        ''')
+        cursor.execute('SELECT 1 FROM booking_stats LIMIT 1')
+        if cursor.fetchone() is None:
+            # New table: count what was booked before it existed
+            cursor.execute(SQL_REBUILD_BOOKING_STATS, (DEFAULT_DURATION,))
+        
+        # Trigram full-text index over client names and phones for the admin
+        # search, kept in sync with clients by triggers
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'clients_search'")
+        if cursor.fetchone() is None:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE clients_search USING fts5 (name, phone, tokenize = 'trigram')
+            ''')
+            cursor.execute('INSERT INTO clients_search (rowid, name, phone) SELECT id, name, phone FROM clients')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS clients_search_insert AFTER INSERT ON clients BEGIN
+            DELETE FROM clients_search WHERE rowid = new.id;
+            INSERT INTO clients_search (rowid, name, phone) VALUES (new.id, new.name, new.phone);
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS clients_search_update AFTER UPDATE OF name, phone ON clients BEGIN
+            UPDATE clients_search SET name = new.name, phone = new.phone WHERE rowid = old.id;
+        END
+        ''')
+        cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS clients_search_delete AFTER DELETE ON clients BEGIN
+            DELETE FROM clients_search WHERE rowid = old.id;
+        END
+        ''')
+        
+        # What changed for the in-memory caches: a key per cache ('barbers',
+        # 'admins', 'working_days', 'archive') or per date ('slots:<date>'),
+        # set to a new highest version in the same transaction as the change.
+        # Worker processes reload only the caches whose keys moved.
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            key TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_cache_versions_version ON cache_versions (version)
+        ''')
+
+# SQL used by the helpers below. Statements on the update path are listed in
+# HOT_QUERIES so check_query_plans() can catch one that stops using its index;
+# startup-only statements over tiny tables are left out.
+# An upsert rather than INSERT OR REPLACE, which would give the client a new
+# id and detach their appointments
+SQL_SAVE_CLIENT = '''
+INSERT INTO clients (user_id, name, phone) VALUES (?, ?, ?)
+ON CONFLICT (user_id) DO UPDATE SET name = excluded.name, phone = excluded.phone
+RETURNING id
+'''
+SQL_CLIENT_ID = 'SELECT id FROM clients WHERE user_id = ?'
+SQL_CLIENT = 'SELECT id, phone FROM clients WHERE user_id = ?'
+SQL_ENQUEUE_MESSAGE = 'INSERT INTO outbox (chat_id, text) VALUES (?, ?)'
+# The oldest pending message of each of the next (at most) ? chats after chat
+# id ? that have pending messages, in chat id order. A skip scan over
+# idx_outbox_chat: one index seek per chat however long its queue is, and the
+# LIMIT inside the recursion stops the walk after that many chats.
+SQL_CHAT_HEADS = '''
+WITH RECURSIVE chats (chat_id) AS (
+    SELECT min(chat_id) FROM outbox WHERE status = 'pending' AND chat_id > ?
+    UNION ALL
+    SELECT (SELECT min(chat_id) FROM outbox WHERE status = 'pending' AND chat_id > chats.chat_id)
+    FROM chats WHERE chat_id IS NOT NULL
+    LIMIT ?
+)
+SELECT o.id, o.chat_id, o.text, o.attempts, o.next_attempt_at FROM chats
+JOIN outbox AS o ON o.id = (SELECT min(id) FROM outbox WHERE chat_id = chats.chat_id AND status = 'pending')
+'''
+SQL_DELETE_MESSAGE = 'DELETE FROM outbox WHERE id = ?'
+SQL_RETRY_MESSAGE = 'UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?'
+SQL_FAIL_MESSAGE = "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?"
+SQL_LOAD_USER_DATA = 'SELECT user_id, data FROM user_data'
+SQL_SAVE_USER_DATA = '''
+INSERT INTO user_data (user_id, data) VALUES (?, ?)
+ON CONFLICT (user_id) DO UPDATE SET data = excluded.data
+'''
+SQL_DROP_USER_DATA = 'DELETE FROM user_data WHERE user_id = ?'
+SQL_LOAD_CONVERSATIONS = 'SELECT key, state FROM conversations WHERE name = ?'
+SQL_SAVE_CONVERSATION = '''
+INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+ON CONFLICT (name, key) DO UPDATE SET state = excluded.state
+'''
+SQL_DROP_CONVERSATION = 'DELETE FROM conversations WHERE name = ? AND key = ?'
+SQL_SEED_ADMIN = 'INSERT OR IGNORE INTO admins (phone) VALUES (?)'
+SQL_BACKFILL_ADMINS = '''
+UPDATE admins SET user_id = (
+    SELECT user_id FROM clients WHERE phone IN (admins.phone, substr(admins.phone, 2))
+)
+WHERE user_id IS NULL
+'''
+SQL_ADMINS = 'SELECT phone, user_id FROM admins'
+SQL_SET_ADMIN_USER_ID = 'UPDATE admins SET user_id = ? WHERE phone = ?'
+SQL_SAVE_APPOINTMENT = '''
+INSERT INTO appointments (client_id, service, date, time, barber_id, duration, reminder_sent_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_RESERVE_SLOT = 'INSERT INTO appointment_slots (date, barber_id, cell, appointment_id) VALUES (?, ?, ?, ?)'
+SQL_BACKFILL_SLOT = 'INSERT OR IGNORE INTO appointment_slots (date, barber_id, cell, appointment_id) VALUES (?, ?, ?, ?)'
+SQL_APPOINTMENT_CELLS = 'SELECT barber_id, cell FROM appointment_slots WHERE appointment_id = ?'
+SQL_RELEASE_SLOTS = 'DELETE FROM appointment_slots WHERE appointment_id = ?'
+SQL_DATE_SLOTS = 'SELECT barber_id, cell FROM appointment_slots WHERE date = ?'
+SQL_SEED_BARBER = '''
+INSERT INTO barbers (name, day_start, day_end) VALUES (?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET day_start = excluded.day_start, day_end = excluded.day_end
+'''
+SQL_BARBERS = 'SELECT id, name, day_start, day_end FROM barbers ORDER BY id'
+SQL_BACKFILL_BARBERS = '''
+UPDATE appointments
+SET barber_id = coalesce(barber_id, (SELECT min(id) FROM barbers)), duration = coalesce(duration, ?)
+WHERE barber_id IS NULL OR duration IS NULL
+'''
+SQL_UNRESERVED_APPOINTMENTS = '''
+SELECT a.id, a.barber_id, a.date, a.time, a.duration FROM appointments a
+WHERE a.status = 'scheduled'
+AND NOT EXISTS (SELECT 1 FROM appointment_slots s WHERE s.appointment_id = a.id)
+'''
+SQL_WORKING_DAYS = 'SELECT date FROM working_days ORDER BY date'
+SQL_ADD_WORKING_DAY = 'INSERT OR IGNORE INTO working_days (date) VALUES (?)'
+SQL_REMOVE_WORKING_DAY = 'DELETE FROM working_days WHERE date = ?'
+# Keyset pagination over the scheduled (date, time) index, whose entries end
+# with the rowid: the cursor is the (date, time, id) of the last/first row
+# shown, so every page is an index seek even when barbers share a time.
+SQL_APPOINTMENTS_AFTER = '''
+SELECT a.id, c.name, c.phone, a.service, a.date, a.time, b.name
+FROM appointments a
+JOIN clients c ON a.client_id = c.id
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE a.status = 'scheduled' AND (a.date, a.time, a.id) > (?, ?, ?) AND a.date <= ?
+ORDER BY a.date, a.time, a.id
+LIMIT ?
+'''
+SQL_APPOINTMENTS_BEFORE = '''
+SELECT a.id, c.name, c.phone, a.service, a.date, a.time, b.name
+FROM appointments a
+JOIN clients c ON a.client_id = c.id
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE a.status = 'scheduled' AND (a.date, a.time, a.id) < (?, ?, ?) AND a.date >= ?
+ORDER BY a.date DESC, a.time DESC, a.id DESC
+LIMIT ?
+'''
+# The row with the highest id, passed in, always stays: without AUTOINCREMENT
+# SQLite would hand a new appointment the id of an archived one, and ids are
+# kept by the reminder scheduler and in done|/unbook| buttons. The unary +
+# keeps the planner on the date index instead of a rowid range from the
+# start of the table.
+SQL_ARCHIVABLE_APPOINTMENTS = '''
+SELECT id FROM appointments
+WHERE date < ? AND (status != 'scheduled' OR date < ?) AND +id < ?
+LIMIT ?
+'''
+SQL_ARCHIVE_APPOINTMENT = '''
+INSERT INTO appointments_archive
+    (appointment_id, client_id, service, date, time, status, barber_id, duration, created_at)
+SELECT id, client_id, service, date, time, status, barber_id, duration, created_at
+FROM appointments WHERE id = ?
+'''
+SQL_DELETE_APPOINTMENT = 'DELETE FROM appointments WHERE id = ?'
+SQL_ARCHIVE_WORKING_DAYS = '''
+INSERT INTO working_days_archive (date, created_at)
+SELECT date, created_at FROM working_days WHERE date < ?
+'''
+SQL_DELETE_WORKING_DAYS = 'DELETE FROM working_days WHERE date < ?'
+SQL_CLOSE_APPOINTMENT = "UPDATE appointments SET status = ? WHERE id = ? AND status = 'scheduled'"
+SQL_APPOINTMENT_SLOT = '''
+SELECT date, time, status, service, duration, client_id, barber_id FROM appointments WHERE id = ?
+'''
+SQL_CLIENT_APPOINTMENTS = '''
+SELECT a.id, a.service, a.date, a.time, b.name
+FROM appointments a
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE a.client_id = ? AND a.status = 'scheduled' AND (a.date, a.time) > (?, ?)
+ORDER BY a.date, a.time
+LIMIT ?
+'''
+SQL_SCHEDULED_SLOTS = 'SELECT barber_id, date, cell FROM appointment_slots WHERE date >= ?'
+SQL_PENDING_REMINDERS = '''
+SELECT id, date, time FROM appointments
+WHERE status = 'scheduled' AND reminder_sent_at IS NULL
+AND (date, time) > (?, ?) AND (date, time) <= (?, ?)
+'''
+SQL_NEW_REMINDERS = '''
+SELECT id, date, time FROM appointments
+WHERE id > ? AND status = 'scheduled' AND reminder_sent_at IS NULL
+'''
+SQL_BUMP_BOOKING_STATS = '''
+INSERT INTO booking_stats (date, service, status, bookings, minutes) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (date, service, status) DO UPDATE
+SET bookings = bookings + excluded.bookings, minutes = minutes + excluded.minutes
+'''
+SQL_BOOKING_STATS = '''
+SELECT date, service, status, bookings, minutes FROM booking_stats
+WHERE date BETWEEN ? AND ?
+'''
+SQL_REBUILD_BOOKING_STATS = '''
+INSERT INTO booking_stats (date, service, status, bookings, minutes)
+SELECT date, service, status, count(*), sum(coalesce(duration, ?)) FROM (
+    SELECT date, service, status, duration FROM appointments
+    UNION ALL
+    SELECT date, service, status, duration FROM appointments_archive
+)
+GROUP BY date, service, status
+'''
+# Export: keyset chunks in (date, rowid) order over the date indexes. The
+# first column is the cursor, the rest are EXPORT_COLUMNS.
+SQL_EXPORT_APPOINTMENTS = '''
+SELECT a.id, a.id, a.date, a.time, a.service, a.status, a.duration, b.name,
+       c.name, c.phone, c.user_id, a.created_at, 0
+FROM appointments a
+LEFT JOIN clients c ON a.client_id = c.id
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE (a.date, a.id) > (?, ?) AND a.date <= ?
+ORDER BY a.date, a.id
+LIMIT ?
+'''
+SQL_EXPORT_ARCHIVED_APPOINTMENTS = '''
+SELECT a.id, a.appointment_id, a.date, a.time, a.service, a.status, a.duration, b.name,
+       c.name, c.phone, c.user_id, a.created_at, 1
+FROM appointments_archive a
+LEFT JOIN clients c ON a.client_id = c.id
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE (a.date, a.id) > (?, ?) AND a.date <= ?
+ORDER BY a.date, a.id
+LIMIT ?
+'''
+SQL_SEARCH_APPOINTMENTS = '''
+SELECT a.id, c.name, c.phone, a.service, a.date, a.time, b.name
+FROM clients_search s
+JOIN clients c ON c.id = s.rowid
+JOIN appointments a ON a.client_id = c.id AND a.status = 'scheduled'
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE clients_search MATCH ?
+ORDER BY a.date, a.time, a.id
+LIMIT ?
+'''
+SQL_LAST_APPOINTMENT_ID = 'SELECT max(id) FROM appointments'
+SQL_CLAIM_REMINDER = '''
+UPDATE appointments SET reminder_sent_at = ?
+WHERE id = ? AND status = 'scheduled' AND reminder_sent_at IS NULL
+'''
+SQL_REMINDER_DETAILS = '''
+SELECT c.user_id, a.service, a.date, a.time, b.name
+FROM appointments a
+JOIN clients c ON a.client_id = c.id
+LEFT JOIN barbers b ON a.barber_id = b.id
+WHERE a.id = ?
+'''
+# WHERE true keeps the parser from reading ON CONFLICT as a join constraint
+SQL_BUMP_CACHE_VERSION = '''
+INSERT INTO cache_versions (key, version)
+SELECT ?, coalesce(max(version), 0) + 1 FROM cache_versions WHERE true
+ON CONFLICT (key) DO UPDATE SET version = excluded.version
+'''
+SQL_CACHE_VERSION = 'SELECT coalesce(max(version), 0) FROM cache_versions'
+SQL_CHANGED_CACHES = 'SELECT key, version FROM cache_versions WHERE version > ? ORDER BY version'
+# The row with the highest version always stays: new versions are max + 1, and
+# workers only look for versions above the last one they saw
+SQL_FORGET_SLOT_VERSIONS = '''
+DELETE FROM cache_versions WHERE key >= 'slots:' AND key < ?
+AND version < (SELECT max(version) FROM cache_versions)
+'''
+
+HOT_QUERIES = {
+    'save_client': SQL_SAVE_CLIENT,
+    'get_client_id': SQL_CLIENT_ID,
+    'get_client': SQL_CLIENT,
+    'register_admin': SQL_SET_ADMIN_USER_ID,
+    'enqueue_messages': SQL_ENQUEUE_MESSAGE,
+    'fetch_chat_heads': SQL_CHAT_HEADS,
+    'settle_messages (sent)': SQL_DELETE_MESSAGE,
+    'settle_messages (retry)': SQL_RETRY_MESSAGE,
+    'settle_messages (failed)': SQL_FAIL_MESSAGE,
+    'save_persistence_batch (user_data)': SQL_SAVE_USER_DATA,
+    'save_persistence_batch (drop user_data)': SQL_DROP_USER_DATA,
+    'save_persistence_batch (conversation)': SQL_SAVE_CONVERSATION,
+    'save_persistence_batch (drop conversation)': SQL_DROP_CONVERSATION,
+    'save_appointment': SQL_SAVE_APPOINTMENT,
+    'save_appointment (reserve)': SQL_RESERVE_SLOT,
+    'save_appointment (refresh)': SQL_DATE_SLOTS,
+    'get_working_days': SQL_WORKING_DAYS,
+    'add_working_days': SQL_ADD_WORKING_DAY,
+    'remove_working_days': SQL_REMOVE_WORKING_DAY,
+    'get_appointments_page (next)': SQL_APPOINTMENTS_AFTER,
+    'get_appointments_page (prev)': SQL_APPOINTMENTS_BEFORE,
+    'close_appointment': SQL_CLOSE_APPOINTMENT,
+    'get_client_appointments': SQL_CLIENT_APPOINTMENTS,
+    'archive_appointments': SQL_ARCHIVABLE_APPOINTMENTS,
+    'archive_appointments (copy)': SQL_ARCHIVE_APPOINTMENT,
+    'archive_appointments (delete)': SQL_DELETE_APPOINTMENT,
+    'archive_working_days': SQL_ARCHIVE_WORKING_DAYS,
+    'archive_working_days (delete)': SQL_DELETE_WORKING_DAYS,
+    'close_appointment (lookup)': SQL_APPOINTMENT_SLOT,
+    'close_appointment (cells)': SQL_APPOINTMENT_CELLS,
+    'close_appointment (release)': SQL_RELEASE_SLOTS,
+    'warm_slot_index': SQL_SCHEDULED_SLOTS,
+    'bump_booking_stats': SQL_BUMP_BOOKING_STATS,
+    'fetch_export_chunk': SQL_EXPORT_APPOINTMENTS,
+    'search_appointments': SQL_SEARCH_APPOINTMENTS,
+    'fetch_export_chunk (archive)': SQL_EXPORT_ARCHIVED_APPOINTMENTS,
+    'get_booking_stats': SQL_BOOKING_STATS,
+    'load_pending_reminders': SQL_PENDING_REMINDERS,
+    'load_new_reminders': SQL_NEW_REMINDERS,
+    'last_appointment_id': SQL_LAST_APPOINTMENT_ID,
+    'send_reminders (claim)': SQL_CLAIM_REMINDER,
+    'send_reminders (details)': SQL_REMINDER_DETAILS,
+    'bump_cache_versions': SQL_BUMP_CACHE_VERSION,
+    'cache_version': SQL_CACHE_VERSION,
+    'refresh_changed_caches': SQL_CHANGED_CACHES,
+    'archive_old_rows (cache versions)': SQL_FORGET_SLOT_VERSIONS,
+}
+
+# Hot queries allowed a temporary ORDER BY sort: it only orders the rows the
+# index lookups matched, and with a LIMIT SQLite keeps just that many of them
+SORTED_QUERIES = {'search_appointments'}
+
+def check_query_plans():
+    """Run EXPLAIN QUERY PLAN on every hot query and return the ones that
+    fall back to a full table scan or a temporary sort, as {name: [plan rows]}.
+    A rowid range open towards the start of the table counts as a scan; one
+    above a cursor, like load_new_reminders' new rows, reads only the tail.
+    Queries in SORTED_QUERIES may sort for their ORDER BY."""
+    problems = {}
+    with db.read() as cursor:
+        for name, sql in HOT_QUERIES.items():
+            params = (None,) * sql.count('?')
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[3] for row in cursor.fetchall()]
+            # Reading a CTE's own rows back is fine, its steps are checked
+            ctes = {'SCAN ' + step.split()[1] for step in plan if step.startswith('MATERIALIZE ')}
+            bad = [step for step in plan
+                   if (step.startswith('SCAN ') and 'INDEX' not in step
+                       and step != 'SCAN CONSTANT ROW' and step not in ctes)
+                   or (step.startswith('USE TEMP B-TREE')
+                       and not (name in SORTED_QUERIES and step == 'USE TEMP B-TREE FOR ORDER BY'))
+                   or '(rowid<' in step]
+            if bad:
+                problems[name] = plan
+    return problems
+
+# Scheduling grid: a day is cut into SLOT_MINUTES cells, and barber hours and
+# bookings are sets of cells, stored as int bitmasks (bit i = i-th cell).
+SLOT_MINUTES = 30
+CELL_TIMES = tuple(f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(0, 24 * 60, SLOT_MINUTES))
+CELL_OF_TIME = {time: cell for cell, time in enumerate(CELL_TIMES)}
+
+def service_duration(service):
+    return SERVICE_DURATIONS.get(service, DEFAULT_DURATION)
+
+def cells_for(duration):
+    return -(-(duration or DEFAULT_DURATION) // SLOT_MINUTES)
+
+def hours_mask(day_start, day_end):
+    return ((1 << CELL_OF_TIME[day_end]) - 1) & ~((1 << CELL_OF_TIME[day_start]) - 1)
+
+def interval_mask(start_cell, cells):
+    return ((1 << cells) - 1) << start_cell
+
+ALL_CELLS = (1 << len(CELL_TIMES)) - 1
+
+def started_cells(date):
+    """Mask of the cells of date that can no longer be booked: all of them
+    for past dates, those already begun for today"""
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
+    if date > today:
+        return 0
+    if date < today:
+        return ALL_CELLS
+    return (1 << (now.hour * 60 + now.minute) // SLOT_MINUTES + 1) - 1
+
+@functools.lru_cache(maxsize=4096)
+def mask_times(mask):
+    """Start times of the set bits of mask, in order"""
+    times = []
+    while mask:
+        low = mask & -mask
+        times.append(CELL_TIMES[low.bit_length() - 1])
+        mask ^= low
+    return tuple(times)
+
+class SlotIndex:
+    """In-memory availability index: a bitmask of busy cells per barber and
+    date, plus each barber's working-hours mask.
+
+    Warmed from appointment_slots at startup and kept current write-through by
+    save_appointment and close_appointment, so availability lookups
+    never touch the database. A barber can start a service at cell s if
+    cells s .. s + n - 1 are all inside their hours and not busy; ANDing the
+    free mask with itself shifted by 1 .. n - 1 yields every such s at once.
+    The combined start mask is memoized per date and service length until
+    that date changes, so listing many dates stays cheap with many barbers.
+    """
+
+    def __init__(self):
+        self._busy = {}  # date -> {barber_id: busy mask}
+        self._hours = {}  # barber_id -> working hours mask
+        self._names = {}  # barber_id -> name
+        self._starts = {}  # date -> {cells: start mask over all barbers}
+        self._lock = threading.Lock()
+
+    def set_barbers(self, rows):
+        self._hours = {barber_id: hours_mask(day_start, day_end) for barber_id, _, day_start, day_end in rows}
+        self._names = {barber_id: name for barber_id, name, _, _ in rows}
+        self._starts = {}
+
+    def barber_name(self, barber_id):
+        return self._names.get(barber_id, '')
+
+    def capacity_minutes(self):
+        """Working minutes of all barbers in one day"""
+        return sum(mask.bit_count() for mask in self._hours.values()) * SLOT_MINUTES
+
+    def warm(self, rows):
+        busy = {}
+        for barber_id, date, cell in rows:
+            barbers = busy.setdefault(date, {})
+            barbers[barber_id] = barbers.get(barber_id, 0) | 1 << cell
+        with self._lock:
+            self._busy = busy
+            self._starts = {}
+
+    def refresh_date(self, date, rows):
+        busy = {}
+        for barber_id, cell in rows:
+            busy[barber_id] = busy.get(barber_id, 0) | 1 << cell
+        with self._lock:
+            self._busy[date] = busy
+            self._starts.pop(date, None)
+
+    def book(self, barber_id, date, mask):
+        with self._lock:
+            barbers = self._busy.setdefault(date, {})
+            barbers[barber_id] = barbers.get(barber_id, 0) | mask
+            self._starts.pop(date, None)
+
+    def release(self, barber_id, date, mask):
+        with self._lock:
+            barbers = self._busy.get(date, {})
+            barbers[barber_id] = barbers.get(barber_id, 0) & ~mask
+            self._starts.pop(date, None)
+
+    def _barber_starts(self, hours, busy, cells):
+        free = hours & ~busy
+        starts = free
+        for shift in range(1, cells):
+            starts &= free >> shift
+        return starts
+
+    def starts_mask(self, date, duration):
+        """Cells at which at least one barber can start a duration-long service"""
+        return self._all_starts(date, cells_for(duration)) & ~started_cells(date)
+
+    def _all_starts(self, date, cells):
+        cached = self._starts.get(date, {})
+        starts = cached.get(cells)
+        if starts is None:
+            with self._lock:
+                busy = self._busy.get(date, {})
+                starts = 0
+                for barber_id, hours in self._hours.items():
+                    starts |= self._barber_starts(hours, busy.get(barber_id, 0), cells)
+                self._starts.setdefault(date, {})[cells] = starts
+        return starts
+
+    def free_barbers(self, date, time, duration):
+        """Barbers free for the whole of a duration-long service starting at time"""
+        if time not in CELL_OF_TIME or started_cells(date) >> CELL_OF_TIME[time] & 1:
+            return []
+        needed = interval_mask(CELL_OF_TIME[time], cells_for(duration))
+        busy = self._busy.get(date, {})
+        return [barber_id for barber_id, hours in self._hours.items()
+                if hours & needed == needed and not busy.get(barber_id, 0) & needed]
+
+    def is_free(self, date, time, duration):
+        return bool(self.free_barbers(date, time, duration))
+
+    def free_times(self, date, duration):
+        return mask_times(self.starts_mask(date, duration))
+
+    def forget_before(self, date):
+        """Drop the masks of dates before date; they can no longer be booked"""
+        with self._lock:
+            for old in [old for old in self._busy if old < date]:
+                del self._busy[old]
+            for old in [old for old in self._starts if old < date]:
+                del self._starts[old]
+
+    def free_counts(self, dates, duration):
+        """Number of free start times on each of dates, none of them past"""
+        cells = cells_for(duration)
+        today = datetime.now().strftime('%Y-%m-%d')
+        return [(self._all_starts(date, cells) & ~started_cells(date) if date == today
+                 else self._all_starts(date, cells)).bit_count() for date in dates]
+
+slot_index = SlotIndex()
+
+def slots_key(date):
+    return 'slots:' + date
+
+def bump_cache_versions(cursor, keys):
+    """Record in the caller's transaction that the caches under keys changed"""
+    cursor.executemany(SQL_BUMP_CACHE_VERSION, [(key,) for key in keys])
+
+@timed_query
+def cache_version():
+    with db.read() as cursor:
+        cursor.execute(SQL_CACHE_VERSION)
+        return cursor.fetchone()[0]
+
+def load_barbers():
+    """Seed BARBERS and move appointments made before barbers and durations
+    existed onto the first barber's schedule"""
+    with db.write() as cursor:
+        cursor.executemany(SQL_SEED_BARBER, BARBERS)
+        bump_cache_versions(cursor, ['barbers'])
+        cursor.execute(SQL_BACKFILL_BARBERS, (DEFAULT_DURATION,))
+        cursor.execute(SQL_UNRESERVED_APPOINTMENTS)
+        for appointment_id, barber_id, date, time, duration in cursor.fetchall():
+            if time not in CELL_OF_TIME:
+                continue
+            start = CELL_OF_TIME[time]
+            cursor.executemany(
+                SQL_BACKFILL_SLOT,
+                [(date, barber_id, cell, appointment_id) for cell in range(start, start + cells_for(duration))]
+            )
+    reload_barbers()
+
+def reload_barbers():
+    with db.read() as cursor:
+        cursor.execute(SQL_BARBERS)
+        slot_index.set_barbers(cursor.fetchall())
+
+def warm_slot_index():
+    with db.read() as cursor:
+        cursor.execute(SQL_SCHEDULED_SLOTS, (datetime.now().strftime('%Y-%m-%d'),))
+        slot_index.warm(cursor.fetchall())
+
+CLIENT_CACHE_SIZE = 100000
+
+class ClientCache:
+    """Telegram user id -> (client id, phone) of clients who shared their
+    contact, so a returning user goes from /start straight to the service
+    menu. Kept write-through by save_client; the least recently used entries
+    beyond CLIENT_CACHE_SIZE are dropped and reloaded from the table on the
+    user's next visit. Each chat is always handled by the same process, so
+    a per-process cache never goes stale."""
+
+    def __init__(self, size=CLIENT_CACHE_SIZE):
+        self._clients = OrderedDict()
+        self._size = size
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            client = self._clients.get(user_id)
+            if client is not None:
+                self._clients.move_to_end(user_id)
+            return client
+
+    def put(self, user_id, client_id, phone):
+        with self._lock:
+            self._clients[user_id] = (client_id, phone)
+            self._clients.move_to_end(user_id)
+            if len(self._clients) > self._size:
+                self._clients.popitem(last=False)
+
+client_cache = ClientCache()
 
 # Helper functions for database operations
+@timed_query
+@writes
 def save_client(user_id, name, phone):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('INSERT OR REPLACE INTO clients (user_id, name, phone) VALUES (?, ?, ?)',
-                  (user_id, name, phone))
-    
-    client_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with db.write() as cursor:
+        cursor.execute(SQL_SAVE_CLIENT, (user_id, name, phone))
+        # Read to the end: a RETURNING statement left open blocks the commit
+        client_id = cursor.fetchall()[0][0]
+    client_cache.put(user_id, client_id, phone)
     
     return client_id
 
+@timed_query
+def get_client(user_id):
+    """(client id, phone) of a user who shared their contact before, or None"""
+    client = client_cache.get(user_id)
+    if client is None:
+        with db.read() as cursor:
+            cursor.execute(SQL_CLIENT, (user_id,))
+            client = cursor.fetchone()
+        if client is not None:
+            client_cache.put(user_id, *client)
+    
+    return client
+
+@timed_query
 def get_client_id(user_id):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT id FROM clients WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    conn.close()
+    with db.read() as cursor:
+        cursor.execute(SQL_CLIENT_ID, (user_id,))
+        result = cursor.fetchone()
     
     return result[0] if result else None
 
-def save_appointment(client_id, service, date, time):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('INSERT INTO appointments (client_id, service, date, time) VALUES (?, ?, ?, ?)',
-                  (client_id, service, date, time))
-    
-    appointment_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    return appointment_id
+def normalize_phone(phone):
+    # Telegram sends contact numbers with or without the leading '+'
+    return '+' + ''.join(ch for ch in phone if ch.isdigit())
+
+class AdminRegistry:
+    """Admin phones and their Telegram user ids, loaded from the admins table
+    at startup so the booking path can find whom to notify without a query."""
+
+    def __init__(self):
+        self._user_ids = {}  # normalized phone -> user_id (None until they share a contact)
+
+    def load(self, rows):
+        self._user_ids = {normalize_phone(phone): user_id for phone, user_id in rows}
+
+    def is_admin(self, phone):
+        return normalize_phone(phone) in self._user_ids
 
+    def needs_update(self, phone, user_id):
+        return self._user_ids.get(normalize_phone(phone), user_id) != user_id
+
+    def set_user_id(self, phone, user_id):
+        self._user_ids[normalize_phone(phone)] = user_id
+
+    def user_ids(self):
+        return [user_id for user_id in self._user_ids.values() if user_id is not None]
+
+admin_registry = AdminRegistry()
+
+def load_admin_registry():
+    with db.write() as cursor:
+        cursor.executemany(SQL_SEED_ADMIN, [(normalize_phone(phone),) for phone in ADMIN_PHONES])
+        cursor.execute(SQL_BACKFILL_ADMINS)
+        bump_cache_versions(cursor, ['admins'])
+    reload_admin_registry()
+
+def reload_admin_registry():
+    with db.read() as cursor:
+        cursor.execute(SQL_ADMINS)
+        admin_registry.load(cursor.fetchall())
+
+@timed_query
+@writes
+def register_admin(phone, user_id):
+    with db.write() as cursor:
+        cursor.execute(SQL_SET_ADMIN_USER_ID, (user_id, normalize_phone(phone)))
+        bump_cache_versions(cursor, ['admins'])
+    admin_registry.set_user_id(phone, user_id)
+
+@timed_query
+@writes
+def save_appointment(client_id, service, date, time, notifications=()):
+    """Atomically reserve the service's cells with the first barber free for
+    all of them. Returns (appointment id, barber id), or (None, None) if every
+    barber offered this time was taken by someone else meanwhile.
+
+    notifications is a list of (chat_id, text) queued in the outbox in the
+    same transaction, only if a barber was reserved; {barber} in the text is
+    replaced by the barber's name."""
+    duration = service_duration(service)
+    start = CELL_OF_TIME.get(time)
+    if start is None:
+        return None, None
+    # Booked too late for a reminder: mark it as done so it is never sent
+    reminder_sent_at = None
+    if reminder_due_at(date, time) <= datetime.now():
+        reminder_sent_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cells = range(start, start + cells_for(duration))
+    appointment_id = barber_id = None
+    with db.write() as cursor:
+        for candidate in slot_index.free_barbers(date, time, duration):
+            cursor.execute('SAVEPOINT reserve')
+            try:
+                cursor.execute(SQL_SAVE_APPOINTMENT, (client_id, service, date, time, candidate,
+                                                      duration, reminder_sent_at))
+                appointment_id = cursor.lastrowid
+                cursor.executemany(SQL_RESERVE_SLOT, [(date, candidate, cell, appointment_id) for cell in cells])
+                barber_id = candidate
+            except sqlite3.IntegrityError:
+                # Booked through another process since our index saw it free
+                cursor.execute('ROLLBACK TO reserve')
+                appointment_id = None
+            cursor.execute('RELEASE reserve')
+            if barber_id is not None:
+                break
+        if barber_id is not None:
+            cursor.execute(SQL_BUMP_BOOKING_STATS, (date, service, 'scheduled', 1, duration))
+            bump_cache_versions(cursor, [slots_key(date)])
+        if barber_id is not None and notifications:
+            name = slot_index.barber_name(barber_id)
+            cursor.executemany(SQL_ENQUEUE_MESSAGE, [(chat_id, text.replace('{barber}', name))
+                                                    for chat_id, text in notifications])
+        if barber_id is None:
+            # Our view of this date is stale; reload it from the table
+            cursor.execute(SQL_DATE_SLOTS, (date,))
+            slot_index.refresh_date(date, cursor.fetchall())
+    if barber_id is not None:
+        slot_index.book(barber_id, date, interval_mask(start, len(cells)))
+    
+    return appointment_id, barber_id
+
+@timed_query
 def get_working_days():
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT date FROM working_days ORDER BY date')
-    dates = [row[0] for row in cursor.fetchall()]
-    
-    conn.close()
+    with db.read() as cursor:
+        cursor.execute(SQL_WORKING_DAYS)
+        dates = [row[0] for row in cursor.fetchall()]
     
     return dates
 
+@timed_query
+@writes
+def add_working_days(dates):
+    """Add all dates in one transaction. Returns (inserted, skipped), skipped
+    being the dates that already were working days."""
+    with db.write() as cursor:
+        cursor.executemany(SQL_ADD_WORKING_DAY, [(date,) for date in dates])
+        inserted = cursor.rowcount
+        if inserted:
+            bump_cache_versions(cursor, ['working_days'])
+    if inserted:
+        reload_working_days()
+    
+    return inserted, len(dates) - inserted
+
+@timed_query
+@writes
+def remove_working_days(dates):
+    """Remove all dates in one transaction. Returns (removed, skipped), skipped
+    being the dates that were not working days."""
+    with db.write() as cursor:
+        cursor.executemany(SQL_REMOVE_WORKING_DAY, [(date,) for date in dates])
+        removed = cursor.rowcount
+        if removed:
+            bump_cache_versions(cursor, ['working_days'])
+    if removed:
+        reload_working_days()
+    
+    return removed, len(dates) - removed
+
+@writes
 def add_working_day(date):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('INSERT INTO working_days (date) VALUES (?)', (date,))
-        conn.commit()
-        success = True
-    except sqlite3.IntegrityError:
-        success = False
-    
-    conn.close()
-    return success
+    return add_working_days([date])[0] == 1
 
+@writes
 def remove_working_day(date):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM working_days WHERE date = ?', (date,))
-    deleted = cursor.rowcount > 0
-    
-    conn.commit()
-    conn.close()
-    
-    return deleted
+    return remove_working_days([date])[0] == 1
 
-def get_available_times(date):
-    # Default time slots
-    all_times = ['10:00', '11:00', '12:00', '13:00', '14:00', '15:00', '16:00', '17:00', '18:00']
-    
-    # Get booked times for the date
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT time FROM appointments WHERE date = ? AND status = "scheduled"', (date,))
-    booked_times = [row[0] for row in cursor.fetchall()]
-    
-    conn.close()
-    
-    # Filter out booked times
-    available_times = [time for time in all_times if time not in booked_times]
-    
-    return available_times
+# Bulk working days: admins describe many dates in one message, e.g.
+#   2030-06-01 2030-06-30          every day of the period
+#   вт-сб 2030-06-01 2030-08-31    Tuesdays to Saturdays of the period
+#   вт-сб 3 мес                    Tuesdays to Saturdays for three months from today
+WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+BULK_DAYS_LIMIT = 366  # longest period accepted in one message, in days
 
-def get_all_appointments():
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT a.id, c.name, c.phone, a.service, a.date, a.time, a.status 
-    FROM appointments a 
-    JOIN clients c ON a.client_id = c.id 
-    WHERE a.status = "scheduled" 
-    ORDER BY a.date, a.time
-    ''')
-    
-    appointments = cursor.fetchall()
-    conn.close()
+BULK_DAYS_HELP = (
+    "Можно указать сразу несколько дней одним сообщением:\n"
+    "• 2030-06-01 2030-06-30 — все дни периода\n"
+    "• вт-сб 2030-06-01 2030-08-31 — только дни недели из списка\n"
+    "• вт-сб 3 мес — эти дни недели на 3 месяца вперёд"
+)
+
+def parse_weekdays(text):
+    """'вт-сб', 'пн,ср,пт' or 'пт-пн' -> set of weekday numbers (Monday is 0)"""
+    weekdays = set()
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        start = WEEKDAY_NAMES.index(first)
+        end = WEEKDAY_NAMES.index(last) if last else start
+        weekdays.update((start + i) % 7 for i in range((end - start) % 7 + 1))
+    return weekdays
+
+def add_months(day, months):
+    year, month = divmod(day.month - 1 + months, 12)
+    month_start = datetime(day.year + year, month + 1, 1)
+    next_month = datetime(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
+    return month_start.date() + timedelta(days=min(day.day, (next_month - month_start).days) - 1)
+
+def parse_days_spec(text, today):
+    """Dates (YYYY-MM-DD, in order) described by an admin's message, see
+    BULK_DAYS_HELP. Raises ValueError for anything else."""
+    tokens = text.lower().split()
+    weekdays = set(range(7))
+    if tokens and tokens[0][:2] in WEEKDAY_NAMES:
+        weekdays = parse_weekdays(tokens.pop(0))
+    if len(tokens) == 2 and tokens[0].isdigit() and tokens[1].startswith('мес'):
+        months = int(tokens[0])
+        # Longer than BULK_DAYS_LIMIT anyway, and huge counts overflow add_months
+        if months > BULK_DAYS_LIMIT // 28:
+            raise ValueError(text)
+        first, last = today, add_months(today, months) - timedelta(days=1)
+    elif len(tokens) in (1, 2):
+        first = datetime.strptime(tokens[0], '%Y-%m-%d').date()
+        last = datetime.strptime(tokens[-1], '%Y-%m-%d').date()
+    else:
+        raise ValueError(text)
+    if last < first or (last - first).days >= BULK_DAYS_LIMIT:
+        raise ValueError(text)
+    days = (first + timedelta(days=i) for i in range((last - first).days + 1))
+    return [day.isoformat() for day in days if day.weekday() in weekdays]
+
+def get_available_times(date, service):
+    # Served from the in-memory index, no database round trip
+    return list(slot_index.free_times(date, service_duration(service)))
+
+BOOKINGS_PAGE_SIZE = 10
+
+@timed_query
+def get_appointments_page(date=None, after=None, before=None, limit=BOOKINGS_PAGE_SIZE):
+    """Fetch one page of scheduled appointments in (date, time, id) order.
+
+    after/before are (date, time, id) cursors from the neighbouring page; with
+    neither, the first page is returned. date restricts the page to one day.
+    Returns (rows, has_prev, has_next)."""
+    first_date, last_date = (date, date) if date else ('', '9999-12-31')
+    with db.read() as cursor:
+        if before:
+            cursor.execute(SQL_APPOINTMENTS_BEFORE, (*before, first_date, limit + 1))
+            rows = cursor.fetchall()
+            has_prev, has_next = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            cursor.execute(SQL_APPOINTMENTS_AFTER, (*(after or (first_date, '', 0)), last_date, limit + 1))
+            rows = cursor.fetchall()
+            has_prev, has_next = after is not None, len(rows) > limit
+            rows = rows[:limit]
     
-    return appointments
+    return rows, has_prev, has_next
+
+def close_appointment(appointment_id, status, client_id=None, after=None, notifications=()):
+    """Move a scheduled appointment to status ('completed' or 'cancelled'),
+    free its cells and update the counters in one transaction.
 
+    With client_id only that client's appointment is closed, with after, a
+    (date, time), only one starting later. notifications are (chat_id, text)
+    queued in the same transaction, with {service}, {date}, {time} and
+    {barber} filled in. Returns those four as a dict, or None if nothing
+    was closed."""
+    with db.write() as cursor:
+        cursor.execute(SQL_APPOINTMENT_SLOT, (appointment_id,))
+        row = cursor.fetchone()
+        if (row is None or row[2] != 'scheduled'
+                or client_id is not None and row[5] != client_id
+                or after is not None and (row[0], row[1]) <= after):
+            return None
+        date, time, _, service, duration, _, barber_id = row
+        duration = duration or DEFAULT_DURATION
+        cursor.execute(SQL_CLOSE_APPOINTMENT, (status, appointment_id))
+        cursor.executemany(SQL_BUMP_BOOKING_STATS, [(date, service, 'scheduled', -1, -duration),
+                                                    (date, service, status, 1, duration)])
+        cursor.execute(SQL_APPOINTMENT_CELLS, (appointment_id,))
+        cells = cursor.fetchall()
+        cursor.execute(SQL_RELEASE_SLOTS, (appointment_id,))
+        bump_cache_versions(cursor, [slots_key(date)])
+        details = {'service': service, 'date': date, 'time': time,
+                   'barber': slot_index.barber_name(barber_id) or '—'}
+        messages = []
+        for chat_id, text in notifications:
+            for key, value in details.items():
+                text = text.replace('{' + key + '}', value)
+            messages.append((chat_id, text))
+        cursor.executemany(SQL_ENQUEUE_MESSAGE, messages)
+    
+    for cell_barber_id, cell in cells:
+        slot_index.release(cell_barber_id, date, 1 << cell)
+    
+    return details
+
+@timed_query
+@writes
 def mark_appointment_completed(appointment_id):
-    conn = sqlite3.connect('barber_shop.db')
-    cursor = conn.cursor()
+    """Returns True if the appointment was scheduled and now is completed"""
+    return close_appointment(appointment_id, 'completed') is not None
+
+@timed_query
+@writes
+def cancel_appointment(appointment_id, client_id, notifications=()):
+    """Cancel a client's own appointment that has not started yet, freeing
+    its time for others at once. Returns its details as close_appointment
+    does, or None if it cannot be cancelled."""
+    if client_id is None:
+        # close_appointment would not check whose appointment it is
+        return None
+    now = datetime.now()
+    return close_appointment(appointment_id, 'cancelled', client_id,
+                             (now.strftime('%Y-%m-%d'), now.strftime('%H:%M')), notifications)
+
+CLIENT_BOOKINGS_LIMIT = 10
+
+@timed_query
+def get_client_appointments(client_id):
+    """A client's upcoming scheduled appointments, earliest first, as
+    (id, service, date, time, barber) rows"""
+    now = datetime.now()
+    with db.read() as cursor:
+        cursor.execute(SQL_CLIENT_APPOINTMENTS, (client_id, now.strftime('%Y-%m-%d'), now.strftime('%H:%M'),
+                                                 CLIENT_BOOKINGS_LIMIT))
+        return cursor.fetchall()
+
+# Admin search over client names and phones
+SEARCH_LIMIT = 10        # appointments shown
+SEARCH_MIN_LENGTH = 3    # the trigram index cannot match shorter words
+SEARCH_HELP = (
+    "🔍 Введите имя клиента, часть номера телефона (от 3 символов) "
+    "или дату в формате ГГГГ-ММ-ДД:"
+)
+
+def search_query(text):
+    """FTS5 query matching clients whose name or phone contains every word
+    of text. Phone-like input is reduced to its digits. Raises ValueError if
+    a word is too short to be looked up."""
+    if all(ch.isdigit() or ch in '+-() ' for ch in text):
+        terms = [''.join(ch for ch in text if ch.isdigit())]
+    else:
+        terms = text.split()
+    if not terms or any(len(term) < SEARCH_MIN_LENGTH for term in terms):
+        raise ValueError(text)
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+@timed_query
+def search_appointments(text):
+    """Scheduled appointments of clients matching text (see search_query),
+    earliest first. Returns (rows, more) with at most SEARCH_LIMIT rows
+    shaped like get_appointments_page's; more is True if some were left out."""
+    with db.read() as cursor:
+        cursor.execute(SQL_SEARCH_APPOINTMENTS, (search_query(text), SEARCH_LIMIT + 1))
+        rows = cursor.fetchall()
+    return rows[:SEARCH_LIMIT], len(rows) > SEARCH_LIMIT
+
+@timed_query
+def get_booking_stats(first, last):
+    """Booking counters for dates first..last, as (date, service, status,
+    bookings, minutes) rows. Reads at most one row per date, service and
+    status, however many appointments there were."""
+    with db.read() as cursor:
+        cursor.execute(SQL_BOOKING_STATS, (first, last))
+        return cursor.fetchall()
+
+def booking_report(first, last):
+    """Summarize dates first..last: bookings per status, bookings per service
+    (most popular first) and the share of barbers' working time booked on
+    each working day or day with bookings, as [(date, percent)]"""
+    statuses, services, booked = {}, {}, {}
+    for date, service, status, bookings, minutes in get_booking_stats(first, last):
+        statuses[status] = statuses.get(status, 0) + bookings
+        services[service] = services.get(service, 0) + bookings
+        if status != 'cancelled':
+            booked[date] = booked.get(date, 0) + minutes
+    capacity = slot_index.capacity_minutes()
+    dates = sorted(set(booked) | {date for date in keyboards.working_days if first <= date <= last})
+    utilization = [(date, round(100 * booked.get(date, 0) / capacity) if capacity else 0) for date in dates]
+    
+    return {
+        'statuses': statuses,
+        'services': sorted(services.items(), key=lambda item: -item[1]),
+        'utilization': utilization,
+    }
+
+def render_booking_report(month):
+    """Admin statistics message for a 'YYYY-MM' month"""
+    first = f"{month}-01"
+    last = add_months(datetime.strptime(first, '%Y-%m-%d').date(), 1) - timedelta(days=1)
+    report = booking_report(first, last.isoformat())
+    statuses = report['statuses']
+    total = sum(statuses.values())
+    if not total and not report['utilization']:
+        return f"📊 Статистика за {month}\n\nЗа этот месяц записей нет."
+    
+    lines = [
+        f"📊 Статистика за {month}\n",
+        f"Записей: {total} (выполнено: {statuses.get('completed', 0)}, "
+        f"запланировано: {statuses.get('scheduled', 0)}, отменено: {statuses.get('cancelled', 0)})",
+    ]
+    if report['services']:
+        lines.append("\n🔹 Услуги:")
+        lines.extend(f"{service} — {bookings}" for service, bookings in report['services'] if bookings)
+    if report['utilization']:
+        lines.append("\n📅 Загрузка мастеров по дням:")
+        lines.extend(f"{date} — {percent}%" for date, percent in report['utilization'])
+    
+    return "\n".join(lines)
+
+# Export of appointments joined with their clients, live and archived
+EXPORT_CHUNK_SIZE = 1000  # rows per query
+EXPORT_COLUMNS = ('id', 'date', 'time', 'service', 'status', 'duration', 'barber',
+                  'client', 'phone', 'user_id', 'created_at', 'archived')
+EXPORT_HELP = (
+    "Введите период выгрузки:\n"
+    "• 2030-06-01 2030-06-30 — с даты по дату\n"
+    "• 2030-06-01 — один день\n"
+    "• все — все записи\n"
+    "Добавьте json, чтобы получить JSON вместо CSV."
+)
+
+@timed_query
+def fetch_export_chunk(sql, after, last, limit):
+    with db.read() as cursor:
+        cursor.execute(sql, (*after, last, limit))
+        return cursor.fetchall()
+
+def iter_export_rows(sql, first, last):
+    """Rows of one export query for dates first..last, fetched
+    EXPORT_CHUNK_SIZE at a time, so no read transaction is held for long and
+    memory use does not grow with the table"""
+    after = (first, 0)
+    while True:
+        rows = fetch_export_chunk(sql, after, last, EXPORT_CHUNK_SIZE)
+        for row in rows:
+            yield row[1:]
+        if len(rows) < EXPORT_CHUNK_SIZE:
+            return
+        after = (rows[-1][2], rows[-1][0])
+
+def iter_export(first, last):
+    """Live and archived appointments for dates first..last in date order"""
+    return heapq.merge(iter_export_rows(SQL_EXPORT_ARCHIVED_APPOINTMENTS, first, last),
+                       iter_export_rows(SQL_EXPORT_APPOINTMENTS, first, last),
+                       key=lambda row: row[1])
+
+def write_export(fileobj, first, last, fmt='csv'):
+    """Write a gzipped CSV or JSON export of dates first..last to the binary
+    fileobj. Returns the number of rows written."""
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+        with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as out:
+            if fmt == 'json':
+                out.write('[')
+                for row in iter_export(first, last):
+                    out.write(',\n' if count else '\n')
+                    out.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                    count += 1
+                out.write('\n]\n')
+            else:
+                writer = csv.writer(out)
+                writer.writerow(EXPORT_COLUMNS)
+                for row in iter_export(first, last):
+                    writer.writerow(row)
+                    count += 1
     
-    cursor.execute('UPDATE appointments SET status = "completed" WHERE id = ?', (appointment_id,))
+    return count
+
+def parse_export_request(text):
+    """(first, last, fmt) for an admin's export request, see EXPORT_HELP.
+    Raises ValueError for anything else."""
+    tokens = text.lower().split()
+    fmt = 'csv'
+    if tokens and tokens[-1] in ('csv', 'json'):
+        fmt = tokens.pop()
+    if tokens == ['все']:
+        return '', '9999-12-31', fmt
+    if len(tokens) not in (1, 2):
+        raise ValueError(text)
+    dates = [datetime.strptime(token, '%Y-%m-%d').strftime('%Y-%m-%d') for token in tokens]
+    if dates[0] > dates[-1]:
+        raise ValueError(text)
+    return dates[0], dates[-1], fmt
+
+# Keyboards shared by all users. Telegram markups are immutable, so each one is
+# built once and reused instead of being rebuilt on every update.
+CONTACT_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton(text="📱 Поделиться номером телефона", request_contact=True)]],
+    one_time_keyboard=True
+)
+SERVICE_KEYBOARD = ReplyKeyboardMarkup(
+    [[service] for service in SERVICES.keys()] + [["📋 Мои записи"], ["❌ Отмена"]],
+    resize_keyboard=True
+)
+CONFIRM_KEYBOARD = ReplyKeyboardMarkup([["✅ Подтвердить"], ["❌ Отмена"]], resize_keyboard=True)
+ADMIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        ["📋 Просмотр записей"],
+        ["➕ Добавить рабочие дни"],
+        ["➖ Удалить рабочие дни"],
+        ["📊 Статистика"],
+        ["📤 Экспорт"],
+        ["🚪 Выход из админ-панели"]
+    ],
+    resize_keyboard=True
+)
+BOOKINGS_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
+        ["✅ Отметить как выполненную"],
+        ["📅 Фильтр по дате"],
+        ["🔍 Поиск"],
+        ["🔙 Назад в меню админа"]
+    ],
+    resize_keyboard=True
+)
+BACK_TO_ADMIN_KEYBOARD = ReplyKeyboardMarkup([["🔙 Назад в меню админа"]], resize_keyboard=True)
+NO_DATES_TEXT = "К сожалению, сейчас нет доступных дат для записи. Пожалуйста, попробуйте позже."
+USE_MENU_BELOW_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Используйте меню ниже", callback_data="ignore")]])
+
+@functools.lru_cache(maxsize=256)
+def _date_keyboard(dates):
+    return ReplyKeyboardMarkup(
+        [[f"{date} (свободно: {count})"] for date, count in dates] + [["❌ Отмена"]], resize_keyboard=True
+    )
+
+def parse_date_button(text):
+    """The date of a client date keyboard button, which also shows a count"""
+    return text.split(' ', 1)[0]
+
+@functools.lru_cache(maxsize=1024)
+def _time_keyboard(starts_mask):
+    free_times = mask_times(starts_mask)
+    keyboard = [list(free_times[i:i + 4]) for i in range(0, len(free_times), 4)]
+    keyboard.append(["❌ Отмена"])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+class KeyboardRegistry:
+    """Cache of the keyboards that depend on data.
+
+    The working-day list and its date keyboards are loaded at startup and
+    reloaded by add_working_day / remove_working_day. Client date and time
+    keyboards are keyed by what they show (dates with their free counts, the
+    mask of free start times), so a booking or completion switches to a
+    different keyboard without any explicit invalidation.
+    """
+
+    def __init__(self):
+        self.working_days = ()
+        self.admin_date_keyboard = None
+
+    def load_working_days(self, dates):
+        dates = tuple(dates)
+        self.admin_date_keyboard = ReplyKeyboardMarkup(
+            [[date] for date in dates] + [["🔙 Назад в меню админа"]], resize_keyboard=True
+        )
+        # Published last: readers on the event loop never see a half-built set
+        self.working_days = dates
+
+    def available_dates(self, service):
+        """Today's and future working days on which service can still be
+        booked, with the number of free start times, from the in-memory index"""
+        working_days = self.working_days
+        upcoming = working_days[bisect.bisect_left(working_days, datetime.now().strftime('%Y-%m-%d')):]
+        counts = slot_index.free_counts(upcoming, service_duration(service))
+        return tuple((date, count) for date, count in zip(upcoming, counts) if count)
+
+    def date_keyboard(self, service):
+        """Client date keyboard for service, or None if no date is left"""
+        dates = self.available_dates(service)
+        return _date_keyboard(dates) if dates else None
+
+    def time_keyboard(self, date, service):
+        return _time_keyboard(slot_index.starts_mask(date, service_duration(service)))
+
+keyboards = KeyboardRegistry()
+
+def reload_working_days():
+    keyboards.load_working_days(get_working_days())
+
+# Admin bookings view
+def format_booking(row):
+    appt_id, name, phone, service, appt_date, appt_time, barber = row
+    return (
+        f"ID: {appt_id} - {name} ({phone})\n"
+        f"Услуга: {service}\n"
+        f"Мастер: {barber or '—'}\n"
+        f"Дата и время: {appt_date} {appt_time}\n"
+        "-------------------"
+    )
+
+def render_search_results(rows, more):
+    """Build the text and inline "mark completed" buttons for search results"""
+    parts = ["🔍 Найденные записи:", ""] + [format_booking(row) for row in rows]
+    if more:
+        parts.append(f"Показаны первые {len(rows)}, уточните запрос.")
+    # Callback data: done|<appointment id>
+    buttons = [[InlineKeyboardButton(f"✅ Выполнена #{row[0]}", callback_data=f"done|{row[0]}")] for row in rows]
+    return "\n".join(parts), InlineKeyboardMarkup(buttons)
+
+def render_bookings_page(rows, has_prev, has_next, date=None):
+    """Build the text and prev/next inline keyboard for one bookings page"""
+    title = f"Активные записи на {date}:" if date else "Активные записи:"
+    parts = [title, ""] + [format_booking(row) for row in rows]
+    
+    # Callback data: bk|<direction>|<date filter>|<cursor date>|<cursor time>|<cursor id>
+    date_filter = date or ''
+    navigation = []
+    if has_prev:
+        first = rows[0]
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"bk|prev|{date_filter}|{first[4]}|{first[5]}|{first[0]}"))
+    if has_next:
+        last = rows[-1]
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"bk|next|{date_filter}|{last[4]}|{last[5]}|{last[0]}"))
+    
+    return "\n".join(parts), InlineKeyboardMarkup([navigation]) if navigation else None
+
+def parse_bookings_callback(callback_data):
+    """Turn bk|... callback data into get_appointments_page keyword arguments"""
+    _, direction, date_filter, cursor_date, cursor_time, *cursor_id = callback_data.split('|')
+    if cursor_id:
+        cursor = (cursor_date, cursor_time, int(cursor_id[0]))
+    else:
+        # Buttons sent before cursors carried the id: skip the whole (date, time)
+        cursor = (cursor_date, cursor_time, 2 ** 63 - 1 if direction == 'next' else -1)
+    return {
+        'date': date_filter or None,
+        'after': cursor if direction == 'next' else None,
+        'before': cursor if direction == 'prev' else None,
+    }
+
+# Outbox: messages are queued in the database and delivered in the background
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 1.0     # seconds between passes when idle
+OUTBOX_GLOBAL_RATE = 25        # messages per second, below Telegram's ~30/s limit
+OUTBOX_PER_CHAT_INTERVAL = 1.0 # seconds between messages to the same chat
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 5.0      # seconds, doubled on every failed attempt
+OUTBOX_BACKOFF_MAX = 3600.0
+
+@timed_query
+def enqueue_messages(messages):
+    """Queue (chat_id, text) pairs for delivery by the outbox dispatcher"""
+    with db.write() as cursor:
+        cursor.executemany(SQL_ENQUEUE_MESSAGE, messages)
+
+FIRST_CHAT = -2 ** 63  # below every chat id; group ids are negative
+
+@timed_query
+def fetch_chat_heads(after_chat, limit):
+    """The oldest pending message of the first `limit` chats after after_chat
+    that have any, as (id, chat_id, text, attempts, next_attempt_at) rows in
+    chat id order"""
+    with db.read() as cursor:
+        cursor.execute(SQL_CHAT_HEADS, (after_chat, limit))
+        return sorted(cursor.fetchall(), key=lambda row: row[1])
+
+@timed_query
+@writes
+def settle_messages(sent, retries, failed):
+    """Record the outcome of a dispatch pass in one transaction.
+
+    sent is a list of ids, retries a list of (attempts, next_attempt_at, error, id)
+    and failed a list of (attempts, error, id)."""
+    with db.write() as cursor:
+        cursor.executemany(SQL_DELETE_MESSAGE, [(message_id,) for message_id in sent])
+        cursor.executemany(SQL_RETRY_MESSAGE, retries)
+        cursor.executemany(SQL_FAIL_MESSAGE, failed)
+
+class OutboxDispatcher:
+    """Background task draining the outbox table in batches.
+
+    Sends stay under Telegram's global and per-chat rate limits, transient
+    errors are retried with exponential backoff, and messages that can never
+    be delivered (bot blocked, chat not found) are marked as failed.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._next_send_at = 0.0   # global pacing, loop time
+        self._chat_ready_at = {}   # chat_id -> loop time of the next allowed send
+        self._chat_cursor = FIRST_CHAT  # chats are visited round robin, in chat id order
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Tell the dispatcher new messages were queued"""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                sent_any = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+                sent_any = False
+            if not sent_any:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def drain_once(self):
+        """Send the oldest message of the next OUTBOX_BATCH_SIZE chats with
+        pending messages, where it is due. Only the head of each chat's queue
+        is sent per pass, so a long backlog for one chat cannot hold up the
+        others, and each chat gets its messages in order. Returns True if
+        anything was sent."""
+        loop = asyncio.get_running_loop()
+        rows = await run_db(fetch_chat_heads, self._chat_cursor, OUTBOX_BATCH_SIZE)
+        if len(rows) < OUTBOX_BATCH_SIZE and self._chat_cursor != FIRST_CHAT:
+            # Past the last chat: wrap around to the ones before the cursor
+            rows += [row for row in await run_db(fetch_chat_heads, FIRST_CHAT, OUTBOX_BATCH_SIZE - len(rows))
+                     if row[1] <= self._chat_cursor]
+        self._chat_cursor = rows[-1][1] if len(rows) == OUTBOX_BATCH_SIZE else FIRST_CHAT
+        due_until = datetime.now().timestamp()
+        sent, retries, failed = [], [], []
+        
+        for message_id, chat_id, text, attempts, next_attempt_at in rows:
+            if next_attempt_at > due_until or loop.time() < self._chat_ready_at.get(chat_id, 0):
+                # Backing off, or the per-chat limit: leave it for a later pass
+                continue
+            await asyncio.sleep(max(0.0, self._next_send_at - loop.time()))
+            
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                sent.append(message_id)
+            except RetryAfter as e:
+                # Flood control: pause all sends and retry without counting an attempt
+                self._next_send_at = loop.time() + e.retry_after
+                retries.append((attempts, datetime.now().timestamp() + e.retry_after, str(e), message_id))
+            except (Forbidden, BadRequest) as e:
+                logger.error(f"Dropping message {message_id} to {chat_id}: {e}")
+                failed.append((attempts + 1, str(e), message_id))
+            except Exception as e:
+                attempts += 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Giving up on message {message_id} to {chat_id}: {e}")
+                    failed.append((attempts, str(e), message_id))
+                else:
+                    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                    retries.append((attempts, datetime.now().timestamp() + delay, str(e), message_id))
+            
+            now = loop.time()
+            self._next_send_at = max(self._next_send_at, now + 1 / OUTBOX_GLOBAL_RATE)
+            self._chat_ready_at[chat_id] = now + OUTBOX_PER_CHAT_INTERVAL
+        
+        if sent or retries or failed:
+            await run_db(settle_messages, sent, retries, failed)
+        
+        if len(self._chat_ready_at) > 1000:
+            now = loop.time()
+            self._chat_ready_at = {chat: t for chat, t in self._chat_ready_at.items() if t > now}
+        
+        return bool(sent)
+
+outbox_dispatcher = OutboxDispatcher()
+
+# Archival: past working days and finished appointments are moved to the
+# *_archive tables so the hot tables stay bounded
+ARCHIVE_INTERVAL = 6 * 3600         # seconds between runs
+ARCHIVE_BATCH_SIZE = 500            # appointments moved per transaction
+APPOINTMENT_RETENTION_DAYS = 7      # past appointments never marked completed stay this long
+
+@timed_query
+def archive_working_days(before):
+    with db.write() as cursor:
+        cursor.execute(SQL_ARCHIVE_WORKING_DAYS, (before,))
+        cursor.execute(SQL_DELETE_WORKING_DAYS, (before,))
+        moved = cursor.rowcount
+        if moved:
+            bump_cache_versions(cursor, ['working_days'])
+    if moved:
+        reload_working_days()
+    
+    return moved
+
+@timed_query
+def archive_appointments(before, scheduled_before, limit):
+    """Move up to limit appointments dated before `before` that are completed,
+    or still scheduled and dated before `scheduled_before`, in one transaction.
+    Returns the number moved."""
+    with db.write() as cursor:
+        cursor.execute(SQL_LAST_APPOINTMENT_ID)
+        newest = cursor.fetchone()[0]
+        if newest is None:
+            return 0
+        cursor.execute(SQL_ARCHIVABLE_APPOINTMENTS, (before, scheduled_before, newest, limit))
+        ids = cursor.fetchall()
+        cursor.executemany(SQL_ARCHIVE_APPOINTMENT, ids)
+        cursor.executemany(SQL_RELEASE_SLOTS, ids)
+        cursor.executemany(SQL_DELETE_APPOINTMENT, ids)
+    
+    return len(ids)
+
+@writes
+def archive_old_rows():
+    """Archive everything that is due, a batch per transaction so bookings
+    are never blocked for long. Returns {table: rows moved}."""
+    today = datetime.now()
+    before = today.strftime('%Y-%m-%d')
+    scheduled_before = (today - timedelta(days=APPOINTMENT_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    stats = {'working_days': archive_working_days(before), 'appointments': 0}
+    while True:
+        moved = archive_appointments(before, scheduled_before, ARCHIVE_BATCH_SIZE)
+        stats['appointments'] += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+    with db.write() as cursor:
+        # Past dates can no longer change, so their keys can go; 'archive'
+        # tells the other workers to drop those dates as well
+        cursor.execute(SQL_FORGET_SLOT_VERSIONS, (slots_key(before),))
+        bump_cache_versions(cursor, ['archive'])
+    slot_index.forget_before(before)
+    for table, moved in stats.items():
+        ARCHIVED_ROWS.inc((table,), moved)
+    
+    return stats
+
+class ArchiveJob:
+    """Background task running archive_old_rows() every ARCHIVE_INTERVAL"""
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                stats = await run_db(archive_old_rows)
+                if any(stats.values()):
+                    logger.info(f"Archived {stats['appointments']} appointments and {stats['working_days']} working days")
+            except Exception as e:
+                logger.error(f"Archival failed: {e}")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+archive_job = ArchiveJob()
+
+# Reminders: clients get a message REMINDER_HOURS before their appointment
+REMINDER_HOURS = 24
+REMINDER_WINDOW = timedelta(hours=6)  # how far ahead reminders are held in memory
+REMINDER_POLL_INTERVAL = 60.0         # seconds between looks for bookings made by other processes
+REMINDER_BATCH_SIZE = 100             # reminders claimed per transaction
+
+def reminder_due_at(date, time):
+    return datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M') - timedelta(hours=REMINDER_HOURS)
+
+@timed_query
+def load_pending_reminders(after, until):
+    """Appointments starting in (after, until], both datetimes, whose reminder
+    was not sent yet, as (id, date, time) rows"""
+    with db.read() as cursor:
+        cursor.execute(SQL_PENDING_REMINDERS, (after.strftime('%Y-%m-%d'), after.strftime('%H:%M'),
+                                               until.strftime('%Y-%m-%d'), until.strftime('%H:%M')))
+        return cursor.fetchall()
+
+@timed_query
+def load_new_reminders(last_id):
+    """Appointments booked since last_id whose reminder was not sent yet"""
+    with db.read() as cursor:
+        cursor.execute(SQL_NEW_REMINDERS, (last_id,))
+        return cursor.fetchall()
+
+@timed_query
+def last_appointment_id():
+    with db.read() as cursor:
+        cursor.execute(SQL_LAST_APPOINTMENT_ID)
+        return cursor.fetchone()[0] or 0
+
+@timed_query
+@writes
+def send_reminders(appointment_ids):
+    """Mark the reminders as sent and queue them in the outbox in one
+    transaction, skipping appointments completed or already reminded
+    meanwhile. Returns the number queued."""
+    sent_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    messages = []
+    with db.write() as cursor:
+        for appointment_id in appointment_ids:
+            cursor.execute(SQL_CLAIM_REMINDER, (sent_at, appointment_id))
+            if not cursor.rowcount:
+                continue
+            cursor.execute(SQL_REMINDER_DETAILS, (appointment_id,))
+            user_id, service, date, time, barber = cursor.fetchone()
+            messages.append((user_id, (
+                f"🔔 Напоминаем о вашей записи\n\n"
+                f"🔹 Услуга: {service}\n"
+                f"💈 Мастер: {barber or '—'}\n"
+                f"📅 Дата: {date}\n"
+                f"⏰ Время: {time}\n\n"
+                f"🙏 Ждём вас!"
+            )))
+        cursor.executemany(SQL_ENQUEUE_MESSAGE, messages)
     
-    conn.commit()
-    conn.close()
+    return len(messages)
+
+class ReminderScheduler:
+    """Background task sending reminders when they fall due.
+
+    Only the reminders of appointments starting within REMINDER_WINDOW of the
+    reminder horizon are held, in a min-heap ordered by due time; the window
+    is moved forward with a range seek on the reminders index. Bookings made
+    in this process are pushed by schedule(), those made by workers are
+    picked up by id every REMINDER_POLL_INTERVAL. reminder_sent_at is the
+    source of truth, so nothing is lost or sent twice across restarts.
+    """
+
+    def __init__(self):
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._heap = []              # (due timestamp, appointment id)
+        self._queued = set()         # ids in the heap; a missing id is a cancelled entry
+        self._loaded_until = None    # appointments starting up to here are loaded
+        self._last_id = 0            # newest appointment id seen
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self):
+        return len(self._queued)
+
+    def _push(self, appointment_id, date, time):
+        if appointment_id in self._queued:
+            return
+        heapq.heappush(self._heap, (reminder_due_at(date, time).timestamp(), appointment_id))
+        self._queued.add(appointment_id)
+
+    def schedule(self, appointment_id, date, time):
+        """Called after a booking; appointments beyond the loaded window are
+        picked up when the window gets there"""
+        if self._task is None or self._loaded_until is None:
+            return
+        if datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M') <= self._loaded_until:
+            self._push(appointment_id, date, time)
+            self._wakeup.set()
+
+    def cancel(self, appointment_id):
+        # Dropped lazily when it reaches the top of the heap
+        self._queued.discard(appointment_id)
+
+    async def refill(self):
+        """Move the window forward if it is running out and pick up bookings
+        made since the last call"""
+        now = datetime.now()
+        horizon = now + timedelta(hours=REMINDER_HOURS) + REMINDER_WINDOW
+        if self._loaded_until is None:
+            self._last_id = await run_db(last_appointment_id)
+            self._loaded_until = now
+        if self._loaded_until <= horizon - REMINDER_WINDOW / 2:
+            for row in await run_db(load_pending_reminders, self._loaded_until, horizon):
+                self._push(*row)
+            self._loaded_until = horizon
+        for appointment_id, date, time in await run_db(load_new_reminders, self._last_id):
+            self._last_id = max(self._last_id, appointment_id)
+            if datetime.strptime(f"{date} {time}", '%Y-%m-%d %H:%M') <= self._loaded_until:
+                self._push(appointment_id, date, time)
+
+    async def send_due(self):
+        """Queue every reminder that is due. Returns the number queued."""
+        now = datetime.now().timestamp()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, appointment_id = heapq.heappop(self._heap)
+            if appointment_id in self._queued:
+                self._queued.discard(appointment_id)
+                due.append(appointment_id)
+        sent = 0
+        for i in range(0, len(due), REMINDER_BATCH_SIZE):
+            sent += await run_db(send_reminders, due[i:i + REMINDER_BATCH_SIZE])
+        if sent:
+            outbox_dispatcher.wake()
+        
+        return sent
+
+    async def _run(self):
+        next_refill = 0.0
+        while True:
+            loop_time = asyncio.get_running_loop().time()
+            try:
+                if loop_time >= next_refill:
+                    await self.refill()
+                    next_refill = loop_time + REMINDER_POLL_INTERVAL
+                await self.send_due()
+            except Exception as e:
+                logger.error(f"Sending reminders failed: {e}")
+            delay = next_refill - loop_time
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - datetime.now().timestamp())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(delay, 0.1))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+reminder_scheduler = ReminderScheduler()
+
+# Conversation persistence
+PERSISTENCE_FLUSH_INTERVAL = 5  # seconds; at most this much state is lost on a crash
+
+@timed_query
+def load_user_data():
+    with db.read() as cursor:
+        cursor.execute(SQL_LOAD_USER_DATA)
+        return {user_id: json.loads(data) for user_id, data in cursor.fetchall()}
+
+@timed_query
+def load_conversations(name):
+    with db.read() as cursor:
+        cursor.execute(SQL_LOAD_CONVERSATIONS, (name,))
+        return {tuple(json.loads(key)): state for key, state in cursor.fetchall()}
+
+@timed_query
+@writes
+def save_persistence_batch(user_data, conversations):
+    """Write buffered state in one transaction.
+
+    user_data maps user_id -> JSON text (None drops the row), conversations
+    maps (name, JSON key) -> state (None drops the row)."""
+    with db.write() as cursor:
+        cursor.executemany(SQL_SAVE_USER_DATA,
+                           [(user_id, data) for user_id, data in user_data.items() if data is not None])
+        cursor.executemany(SQL_DROP_USER_DATA,
+                           [(user_id,) for user_id, data in user_data.items() if data is None])
+        cursor.executemany(SQL_SAVE_CONVERSATION,
+                           [(name, key, state) for (name, key), state in conversations.items() if state is not None])
+        cursor.executemany(SQL_DROP_CONVERSATION,
+                           [(name, key) for (name, key), state in conversations.items() if state is None])
+
+class SQLitePersistence(BasePersistence):
+    """Keeps user_data and conversation states in the bot database so a
+    restart resumes half-finished bookings.
+
+    The Application hands over only the entries touched since its last run,
+    every update_interval seconds. They are buffered here and written in a
+    single transaction on the DB thread pool, so no handler ever waits for a
+    persistence write.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._dirty_user_data = {}
+        self._dirty_conversations = {}
+        self._flush_task = None
+        # Batches are written one at a time, in order, so an older state can
+        # never overwrite a newer one
+        self._write_lock = asyncio.Lock()
+
+    def _schedule_flush(self):
+        # Application.update_persistence() calls the update_* methods for all
+        # dirty entries in one gather; one task writes the whole batch after them
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_dirty())
+
+    async def _flush_dirty(self):
+        await asyncio.sleep(0)
+        self._flush_task = None
+        user_data, self._dirty_user_data = self._dirty_user_data, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        async with self._write_lock:
+            if not user_data and not conversations:
+                return
+            try:
+                await run_db(save_persistence_batch, user_data, conversations)
+            except Exception as e:
+                logger.error(f"Failed to persist conversation state: {e}")
+                # Keep the batch for the next run unless newer state arrived meanwhile
+                for user_id, data in user_data.items():
+                    self._dirty_user_data.setdefault(user_id, data)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+
+    async def get_user_data(self):
+        return await run_db(load_user_data)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversations = await run_db(load_conversations, name)
+        active_conversations.update(conversations)  # restored ones are still in flight
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id, data):
+        self._dirty_user_data[user_id] = json.dumps(data, ensure_ascii=False)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Called once on shutdown after the final update_persistence(); the
+        # last _flush_dirty() also waits for a batch still being written
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_dirty()
 
 # Calendar helper functions
+CALENDAR_CACHE_SIZE = 32  # months kept; admins rarely page far from today
+
+_calendar_cache_day = None
+
 def generate_calendar_markup(year, month):
     """Generate an inline keyboard markup for a calendar"""
+    global _calendar_cache_day
+    # Which days are selectable depends on today, so the cache is dropped at midnight
+    today = datetime.now().date()
+    if today != _calendar_cache_day:
+        _calendar_markup.cache_clear()
+        _calendar_cache_day = today
+    return _calendar_markup(year, month, today)
+
+@functools.lru_cache(maxsize=CALENDAR_CACHE_SIZE)
+def _calendar_markup(year, month, today):
+    # Markups are immutable, so one instance is safely shared by every admin
     calendar_markup = []
     
     # Add month and year as header
@@ -228,7 +2326,6 @@ def generate_calendar_markup(year, month):
     first_weekday = first_day.weekday()
     
     # Create calendar grid
-    current_date = datetime.now().date()
     day = 1
     for week in range(6):  # Maximum 6 weeks in a month
         week_buttons = []
@@ -240,9 +2337,7 @@ def generate_calendar_markup(year, month):
                 # Date cell
                 date_str = f"{year}-{month:02d}-{day:02d}"
                 # Only allow selecting current or future dates
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                
-                if date_obj >= current_date:
+                if (year, month, day) >= (today.year, today.month, today.day):
                     week_buttons.append(InlineKeyboardButton(f"{day}", callback_data=f"date:{date_str}"))
                 else:
                     week_buttons.append(InlineKeyboardButton(f"{day}", callback_data="ignore"))
@@ -256,21 +2351,72 @@ def generate_calendar_markup(year, month):
     
     return InlineKeyboardMarkup(calendar_markup)
 
+# Update processing
+MAX_CONCURRENT_UPDATES = 64
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently while keeping each
+    user's own updates strictly in order, which ConversationHandler relies on."""
+
+    def __init__(self, max_concurrent_updates):
+        # The base class takes its semaphore before do_process_update, where
+        # updates wait for the user's lock, so it gets a limit that is never
+        # reached and ours is taken after the lock instead: updates queued
+        # behind the same user's earlier ones must not hold slots other
+        # users' updates could run in.
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}  # (chat_id, user_id) -> [lock, number of waiting updates]
+
+    async def do_process_update(self, update, coroutine):
+        if not isinstance(update, Update) or update.effective_user is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        key = (chat_id, update.effective_user.id)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # Command handlers
 async def start(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
     context.user_data.clear()
     
-    # Check if user is admin by requesting phone number
-    keyboard = [
-        [KeyboardButton(text="📱 Поделиться номером телефона", request_contact=True)]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+    # Returning clients skip the contact step. Admins always share their
+    # contact: only a contact of their own proves it is them.
+    client = client_cache.get(user.id) or await run_db(get_client, user.id)
+    if client is not None and not admin_registry.is_admin(client[1]):
+        context.user_data['client_id'], context.user_data['phone'] = client
+        message = await update.message.reply_text(
+            f"С возвращением, {user.first_name}! Выберите услугу:",
+            reply_markup=SERVICE_KEYBOARD
+        )
+        context.user_data['last_message_id'] = message.message_id
+        return CHOOSE_SERVICE
     
+    # Check if user is admin by requesting phone number
     await update.message.reply_text(
         f"Здравствуйте, {user.first_name}! Добро пожаловать в бот записи к парикмахеру. "
         f"Пожалуйста, поделитесь своим номером телефона для продолжения.",
-        reply_markup=reply_markup
+        reply_markup=CONTACT_KEYBOARD
     )
     
     return PROVIDE_CONTACT
@@ -281,47 +2427,93 @@ async def handle_contact(update: Update, context: CallbackContext) -> int:
     phone = contact.phone_number
     
     # Save client info
-    client_id = save_client(user.id, user.first_name, phone)
+    client_id = await run_db(save_client, user.id, user.first_name, phone)
     context.user_data['client_id'] = client_id
     context.user_data['phone'] = phone
     
     # Store the last message ID for future edits
     context.user_data['last_message_id'] = update.message.message_id
     
-    # Check if user is admin
-    if phone == ADMIN_PHONE:
-        # Create admin menu with persistent keyboard
-        keyboard = [
-            ["📋 Просмотр записей"],
-            ["➕ Добавить рабочие дни"],
-            ["➖ Удалить рабочие дни"],
-            ["🚪 Выход из админ-панели"]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    # Check if user is admin. Only trust the user's own contact, not a
+    # forwarded card with someone else's number.
+    if contact.user_id == user.id and admin_registry.is_admin(phone):
+        if admin_registry.needs_update(phone, user.id):
+            await run_db(register_admin, phone, user.id)
         
         # Send a new message with the admin menu
         message = await update.message.reply_text(
             "Вы вошли как администратор. Выберите действие:",
-            reply_markup=reply_markup
+            reply_markup=ADMIN_MENU_KEYBOARD
         )
         context.user_data['last_message_id'] = message.message_id
         return ADMIN_MENU
     else:
         # Regular client flow with persistent keyboard
-        keyboard = []
-        for service in SERVICES.keys():
-            keyboard.append([service])
-        keyboard.append(["❌ Отмена"])
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
-        # Send a new message with the service selection menu
         message = await update.message.reply_text(
             "Выберите услугу:",
-            reply_markup=reply_markup
+            reply_markup=SERVICE_KEYBOARD
         )
         context.user_data['last_message_id'] = message.message_id
         return CHOOSE_SERVICE
 
+async def show_my_bookings(update: Update, context: CallbackContext) -> int:
+    rows = await run_db(get_client_appointments, context.user_data['client_id'])
+    if not rows:
+        await update.message.reply_text("У вас нет предстоящих записей.", reply_markup=SERVICE_KEYBOARD)
+        return CHOOSE_SERVICE
+    
+    parts = ["📋 Ваши предстоящие записи:", ""]
+    buttons = []
+    for appointment_id, service, date, time, barber in rows:
+        parts.append(f"🔹 {service}\n💈 Мастер: {barber or '—'}\n📅 {date} ⏰ {time}\n")
+        # Callback data: unbook|<appointment id>
+        buttons.append([InlineKeyboardButton(f"❌ Отменить {date} {time}", callback_data=f"unbook|{appointment_id}")])
+    await update.message.reply_text("\n".join(parts), reply_markup=InlineKeyboardMarkup(buttons))
+    return CHOOSE_SERVICE
+
+async def cancel_my_booking(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    await query.answer()
+    appointment_id = int(query.data.split('|')[1])
+    
+    if context.user_data.get('client_id') is None:
+        # A button left from an earlier conversation
+        client = client_cache.get(update.effective_user.id) or await run_db(get_client, update.effective_user.id)
+        if client is None:
+            await update.effective_chat.send_message("Эту запись уже нельзя отменить.")
+            return ConversationHandler.END
+        context.user_data['client_id'], context.user_data['phone'] = client
+    
+    admin_message = (
+        f"❌ Клиент отменил запись\n\n"
+        f"👤 Клиент: {update.effective_user.first_name}\n"
+        f"📱 Телефон: {context.user_data.get('phone')}\n"
+        f"🔹 Услуга: {{service}}\n"
+        f"💈 Мастер: {{barber}}\n"
+        f"📅 Дата: {{date}}\n"
+        f"⏰ Время: {{time}}"
+    )
+    notifications = [(admin_user_id, admin_message) for admin_user_id in admin_registry.user_ids()]
+    # Freeing the time and notifying the admins is a single write
+    details = await run_db(cancel_appointment, appointment_id, context.user_data['client_id'], notifications)
+    
+    if query.message and query.message.reply_markup:
+        buttons = [row for row in query.message.reply_markup.inline_keyboard
+                   if row[0].callback_data != query.data]
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(buttons))
+    if details is None:
+        await update.effective_chat.send_message("Эту запись уже нельзя отменить.", reply_markup=SERVICE_KEYBOARD)
+        return CHOOSE_SERVICE
+    
+    reminder_scheduler.cancel(appointment_id)
+    if notifications:
+        outbox_dispatcher.wake()
+    await update.effective_chat.send_message(
+        f"✅ Запись на {details['date']} {details['time']} отменена.",
+        reply_markup=SERVICE_KEYBOARD
+    )
+    return CHOOSE_SERVICE
+
 async def choose_service(update: Update, context: CallbackContext) -> int:
     # Handle text input from ReplyKeyboardMarkup
     if update.message:
@@ -332,18 +2524,15 @@ async def choose_service(update: Update, context: CallbackContext) -> int:
             await update.message.reply_text("Запись отменена.", reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
             
+        if service == "📋 Мои записи":
+            return await show_my_bookings(update, context)
+        
         # Check if the service is valid
         if service not in SERVICES.keys():
             # If not a valid service, ask again
-            keyboard = []
-            for service_key in SERVICES.keys():
-                keyboard.append([service_key])
-            keyboard.append(["❌ Отмена"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
             await update.message.reply_text(
                 "Пожалуйста, выберите услугу из предложенных вариантов:",
-                reply_markup=reply_markup
+                reply_markup=SERVICE_KEYBOARD
             )
             return CHOOSE_SERVICE
     # For backward compatibility, still handle callback queries
@@ -354,31 +2543,22 @@ async def choose_service(update: Update, context: CallbackContext) -> int:
         
     context.user_data['service'] = service
     
-    # Get available dates
-    available_dates = get_working_days()
-    
-    if not available_dates:
-        message_text = "К сожалению, сейчас нет доступных дат для записи. Пожалуйста, попробуйте позже."
+    # Only dates that still have a free start time for this service are offered
+    reply_markup = keyboards.date_keyboard(service)
+    if reply_markup is None:
+        message_text = NO_DATES_TEXT
         if update.message:
             await update.message.reply_text(message_text, reply_markup=ReplyKeyboardRemove())
         else:
             await query.edit_message_text(message_text)
         return ConversationHandler.END
     
-    # Create keyboard with dates
-    keyboard = []
-    for date in available_dates:
-        keyboard.append([date])
-    
-    keyboard.append(["❌ Отмена"])
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
     message_text = f"Вы выбрали: {service}\n📅 Теперь выберите дату:"
     
     if update.message:
         await update.message.reply_text(message_text, reply_markup=reply_markup)
     else:
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Используйте меню ниже", callback_data="ignore")]]))
+        await query.edit_message_text(message_text, reply_markup=USE_MENU_BELOW_MARKUP)
         await update.effective_chat.send_message(message_text, reply_markup=reply_markup)
     
     return CHOOSE_DATE
@@ -394,22 +2574,18 @@ async def choose_date(update: Update, context: CallbackContext) -> int:
             return ConversationHandler.END
             
         # Validate the date format
-        available_dates = get_working_days()
-        if date_text not in available_dates:
+        date = parse_date_button(date_text)
+        if date not in keyboards.working_days:
             # If not a valid date, ask again
-            keyboard = []
-            for date in available_dates:
-                keyboard.append([date])
-            keyboard.append(["❌ Отмена"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
+            reply_markup = keyboards.date_keyboard(context.user_data['service'])
+            if reply_markup is None:
+                await update.message.reply_text(NO_DATES_TEXT, reply_markup=ReplyKeyboardRemove())
+                return ConversationHandler.END
             await update.message.reply_text(
                 "Пожалуйста, выберите дату из предложенных вариантов:",
                 reply_markup=reply_markup
             )
             return CHOOSE_DATE
-            
-        date = date_text
     # For backward compatibility, still handle callback queries
     else:
         query = update.callback_query
@@ -424,19 +2600,20 @@ async def choose_date(update: Update, context: CallbackContext) -> int:
     context.user_data['date'] = date
     
     # Get available times for the selected date
-    available_times = get_available_times(date)
+    available_times = get_available_times(date, context.user_data['service'])
     
     if not available_times:
         message_text = f"К сожалению, на {date} нет свободных слотов. Пожалуйста, выберите другую дату."
         
-        # Return to date selection
-        available_dates = get_working_days()
-        keyboard = []
-        for d in available_dates:
-            keyboard.append([d])
-        
-        keyboard.append(["❌ Отмена"])
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        # Return to date selection; the date keyboard no longer lists this date
+        reply_markup = keyboards.date_keyboard(context.user_data['service'])
+        if reply_markup is None:
+            message_text += "\n\n" + NO_DATES_TEXT
+            if update.message:
+                await update.message.reply_text(message_text, reply_markup=ReplyKeyboardRemove())
+            else:
+                await query.edit_message_text(message_text)
+            return ConversationHandler.END
         
         if update.message:
             await update.message.reply_text(message_text)
@@ -452,24 +2629,14 @@ async def choose_date(update: Update, context: CallbackContext) -> int:
             )
         return CHOOSE_DATE
     
-    # Create keyboard with times
-    keyboard = []
-    row = []
-    for i, time in enumerate(available_times):
-        row.append(time)
-        if (i + 1) % 3 == 0 or i == len(available_times) - 1:
-            keyboard.append(row)
-            row = []
-    
-    keyboard.append(["❌ Отмена"])
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = keyboards.time_keyboard(date, context.user_data['service'])
     
     message_text = f"Вы выбрали: {context.user_data['service']} на {date}\n⏰ Теперь выберите время:"
     
     if update.message:
         await update.message.reply_text(message_text, reply_markup=reply_markup)
     else:
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Используйте меню ниже", callback_data="ignore")]]))
+        await query.edit_message_text(message_text, reply_markup=USE_MENU_BELOW_MARKUP)
         await update.effective_chat.send_message(message_text, reply_markup=reply_markup)
     
     return CHOOSE_TIME
@@ -485,22 +2652,12 @@ async def choose_time(update: Update, context: CallbackContext) -> int:
             return ConversationHandler.END
             
         # Validate the time format
-        available_times = get_available_times(context.user_data['date'])
-        if time_text not in available_times:
+        duration = service_duration(context.user_data['service'])
+        if not slot_index.is_free(context.user_data['date'], time_text, duration):
             # If not a valid time, ask again
-            keyboard = []
-            row = []
-            for i, time in enumerate(available_times):
-                row.append(time)
-                if (i + 1) % 3 == 0 or i == len(available_times) - 1:
-                    keyboard.append(row)
-                    row = []
-            keyboard.append(["❌ Отмена"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
             await update.message.reply_text(
                 "Пожалуйста, выберите время из предложенных вариантов:",
-                reply_markup=reply_markup
+                reply_markup=keyboards.time_keyboard(context.user_data['date'], context.user_data['service'])
             )
             return CHOOSE_TIME
             
@@ -519,23 +2676,20 @@ async def choose_time(update: Update, context: CallbackContext) -> int:
     context.user_data['time'] = time
     
     # Confirm booking
-    keyboard = [
-        ["✅ Подтвердить"],
-        ["❌ Отмена"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = CONFIRM_KEYBOARD
     
     message_text = (
         f"Подтвердите вашу запись:\n"
         f"Услуга: {context.user_data['service']}\n"
         f"Дата: {context.user_data['date']}\n"
-        f"Время: {context.user_data['time']}"
+        f"Время: {context.user_data['time']}\n"
+        f"Длительность: {service_duration(context.user_data['service'])} мин"
     )
     
     if update.message:
         await update.message.reply_text(message_text, reply_markup=reply_markup)
     else:
-        await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Используйте меню ниже", callback_data="ignore")]]))
+        await query.edit_message_text(message_text, reply_markup=USE_MENU_BELOW_MARKUP)
         await update.effective_chat.send_message(message_text, reply_markup=reply_markup)
     
     return CONFIRM_BOOKING
@@ -553,15 +2707,9 @@ async def confirm_booking(update: Update, context: CallbackContext) -> int:
         # Check if the user confirmed
         if confirmation != "✅ Подтвердить":
             # If not a valid confirmation, ask again
-            keyboard = [
-                ["✅ Подтвердить"],
-                ["❌ Отмена"]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
             await update.message.reply_text(
                 "Пожалуйста, подтвердите или отмените запись:",
-                reply_markup=reply_markup
+                reply_markup=CONFIRM_KEYBOARD
             )
             return CONFIRM_BOOKING
     # For backward compatibility, still handle callback queries
@@ -579,11 +2727,47 @@ async def confirm_booking(update: Update, context: CallbackContext) -> int:
     date = context.user_data['date']
     time = context.user_data['time']
     
-    appointment_id = save_appointment(client_id, service, date, time)
+    admin_message = (
+        f"📣 Новая запись!\n\n"
+        f"👤 Клиент: {update.effective_user.first_name}\n"
+        f"📱 Телефон: {context.user_data['phone']}\n"
+        f"🔹 Услуга: {service}\n"
+        f"💈 Мастер: {{barber}}\n"
+        f"📅 Дата: {date}\n"
+        f"⏰ Время: {time}"
+    )
+    notifications = [(admin_user_id, admin_message) for admin_user_id in admin_registry.user_ids()]
+    
+    # Reserving the slot and queueing the admin notifications is a single write
+    appointment_id, barber_id = await run_db(save_appointment, client_id, service, date, time, notifications)
+    
+    if appointment_id is None:
+        # Someone else booked this slot after it was offered to us
+        available_times = get_available_times(date, service)
+        message_text = f"😔 К сожалению, время {time} на {date} уже занято."
+        
+        if not available_times:
+            message_text += "\nНа эту дату больше нет свободных слотов. Начните заново: /start"
+            if update.message:
+                await update.message.reply_text(message_text, reply_markup=ReplyKeyboardRemove())
+            else:
+                await query.edit_message_text(message_text)
+            return ConversationHandler.END
+        
+        reply_markup = keyboards.time_keyboard(date, service)
+        
+        message_text += "\n⏰ Пожалуйста, выберите другое время:"
+        if update.message:
+            await update.message.reply_text(message_text, reply_markup=reply_markup)
+        else:
+            await query.edit_message_text(message_text)
+            await update.effective_chat.send_message("Используйте меню ниже:", reply_markup=reply_markup)
+        return CHOOSE_TIME
     
     confirmation_message = (
         f"✅ Ваша запись успешно подтверждена!\n\n"
         f"🔹 Услуга: {service}\n"
+        f"💈 Мастер: {slot_index.barber_name(barber_id)}\n"
         f"📅 Дата: {date}\n"
         f"⏰ Время: {time}\n\n"
         f"🙏 Мы будем ждать вас! В случае необходимости с вами свяжутся по указанному номеру телефона."
@@ -594,27 +2778,10 @@ async def confirm_booking(update: Update, context: CallbackContext) -> int:
     else:
         await query.edit_message_text(confirmation_message)
     
-    # Send notification to admin
-    try:
-        # Get admin user_id from database
-        conn = sqlite3.connect('barber_shop.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM clients WHERE phone = ?', (ADMIN_PHONE,))
-        admin_user_id = cursor.fetchone()
-        conn.close()
-        
-        if admin_user_id:
-            admin_message = (
-                f"📣 Новая запись!\n\n"
-                f"👤 Клиент: {update.effective_user.first_name}\n"
-                f"📱 Телефон: {context.user_data['phone']}\n"
-                f"🔹 Услуга: {service}\n"
-                f"📅 Дата: {date}\n"
-                f"⏰ Время: {time}"
-            )
-            await context.bot.send_message(chat_id=admin_user_id[0], text=admin_message)
-    except Exception as e:
-        logger.error(f"Failed to send admin notification: {e}")
+    # Admin notifications are delivered by the outbox dispatcher
+    if notifications:
+        outbox_dispatcher.wake()
+    reminder_scheduler.schedule(appointment_id, date, time)
     
     return ConversationHandler.END
 
@@ -626,31 +2793,7 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
         
         # Handle admin menu options
         if admin_choice == "📋 Просмотр записей":
-            appointments = get_all_appointments()
-            
-            if not appointments:
-                await update.message.reply_text(
-                    "Нет активных записей.\n\n"
-                    "Вернуться в /start"
-                )
-                return ConversationHandler.END
-            
-            message = "Активные записи:\n\n"
-            for appt in appointments:
-                appt_id, name, phone, service, date, time, status = appt
-                message += f"ID: {appt_id} - {name} ({phone})\n"
-                message += f"Услуга: {service}\n"
-                message += f"Дата и время: {date} {time}\n"
-                message += "-------------------\n"
-            
-            keyboard = [
-                ["✅ Отметить как выполненную"],
-                ["🔙 Назад в меню админа"]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text(message, reply_markup=reply_markup)
-            return ADMIN_VIEW_BOOKINGS
+            return await send_bookings_page(update, context)
         
         elif admin_choice == "➕ Добавить рабочие дни":
             # Generate calendar for date selection
@@ -662,31 +2805,34 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
                 "📅 Выберите дату для добавления в рабочие дни:",
                 reply_markup=calendar_markup
             )
+            await update.message.reply_text(BULK_DAYS_HELP, reply_markup=BACK_TO_ADMIN_KEYBOARD)
             return ADMIN_ADD_DATES
         
         elif admin_choice == "➖ Удалить рабочие дни":
-            available_dates = get_working_days()
-            
-            if not available_dates:
+            if not keyboards.working_days:
                 await update.message.reply_text(
                     "Нет доступных рабочих дней для удаления.\n\n"
                     "Вернуться в /start"
                 )
                 return ConversationHandler.END
             
-            keyboard = []
-            for date in available_dates:
-                keyboard.append([date])
-            
-            keyboard.append(["🔙 Назад в меню админа"])
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup = keyboards.admin_date_keyboard
             
             await update.message.reply_text(
-                "📅 Выберите дату для удаления:",
+                "📅 Выберите дату для удаления:\n\n" + BULK_DAYS_HELP,
                 reply_markup=reply_markup
             )
             return ADMIN_REMOVE_DATES
         
+        elif admin_choice == "📊 Статистика":
+            report = await run_db(render_booking_report, datetime.now().strftime('%Y-%m'))
+            await update.message.reply_text(report, reply_markup=ADMIN_MENU_KEYBOARD)
+            return ADMIN_MENU
+        
+        elif admin_choice == "📤 Экспорт":
+            await update.message.reply_text(EXPORT_HELP, reply_markup=BACK_TO_ADMIN_KEYBOARD)
+            return ADMIN_EXPORT
+        
         elif admin_choice == "🚪 Выход из админ-панели":
             await update.message.reply_text(
                 "Вы вышли из админ-панели.\n\n"
@@ -696,17 +2842,9 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
             return ConversationHandler.END
         
         elif admin_choice == "🔙 Назад в меню админа":
-            keyboard = [
-                ["📋 Просмотр записей"],
-                ["➕ Добавить рабочие дни"],
-                ["➖ Удалить рабочие дни"],
-                ["🚪 Выход из админ-панели"]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
             await update.message.reply_text(
                 "Вы вошли как администратор. Выберите действие:",
-                reply_markup=reply_markup
+                reply_markup=ADMIN_MENU_KEYBOARD
             )
             return ADMIN_MENU
     # For backward compatibility, still handle callback queries
@@ -715,38 +2853,8 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
         await query.answer()
         
         if query.data == 'view_bookings':
-            appointments = get_all_appointments()
-            
-            if not appointments:
-                await query.edit_message_text(
-                    "Нет активных записей.\n\n"
-                    "Вернуться в /start"
-                )
-                return ConversationHandler.END
-            
-            message = "Активные записи:\n\n"
-            for appt in appointments:
-                appt_id, name, phone, service, date, time, status = appt
-                message += f"ID: {appt_id} - {name} ({phone})\n"
-                message += f"Услуга: {service}\n"
-                message += f"Дата и время: {date} {time}\n"
-                message += "-------------------\n"
-            
-            # Create persistent keyboard
-            keyboard = [
-                ["✅ Отметить как выполненную"],
-                ["🔙 Назад в меню админа"]
-            ]
-            reply_markup_persistent = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            # First edit the inline message
-            await query.edit_message_text(message)
-            # Then send a new message with the persistent keyboard
-            await update.effective_chat.send_message(
-                "Используйте меню ниже для дальнейших действий:",
-                reply_markup=reply_markup_persistent
-            )
-            return ADMIN_VIEW_BOOKINGS
+            await query.edit_message_text("📋 Просмотр записей")
+            return await send_bookings_page(update, context)
         
         elif query.data == 'add_dates':
             # Generate calendar for date selection
@@ -760,9 +2868,7 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
             return ADMIN_ADD_DATES
         
         elif query.data == 'remove_dates':
-            available_dates = get_working_days()
-            
-            if not available_dates:
+            if not keyboards.working_days:
                 await query.edit_message_text(
                     "Нет доступных рабочих дней для удаления.\n\n"
                     "Вернуться в /start"
@@ -770,12 +2876,7 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
                 return ConversationHandler.END
             
             # Create persistent keyboard
-            keyboard = []
-            for date in available_dates:
-                keyboard.append([date])
-            
-            keyboard.append(["🔙 Назад в меню админа"])
-            reply_markup_persistent = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup_persistent = keyboards.admin_date_keyboard
             
             # First edit the inline message
             await query.edit_message_text("📅 Выберите дату для удаления:")
@@ -794,32 +2895,55 @@ async def admin_menu(update: Update, context: CallbackContext) -> int:
             return ConversationHandler.END
         
         elif query.data == 'back_to_admin':
-            # Create persistent keyboard
-            keyboard = [
-                ["📋 Просмотр записей"],
-                ["➕ Добавить рабочие дни"],
-                ["➖ Удалить рабочие дни"],
-                ["🚪 Выход из админ-панели"]
-            ]
-            reply_markup_persistent = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
             # First edit the inline message
             await query.edit_message_text("Вы вошли как администратор. Выберите действие:")
             # Then send a new message with the persistent keyboard
             await update.effective_chat.send_message(
                 "Используйте меню ниже для выбора действия:",
-                reply_markup=reply_markup_persistent
+                reply_markup=ADMIN_MENU_KEYBOARD
             )
             return ADMIN_MENU
     
     return ADMIN_MENU
 
+async def send_bookings_page(update: Update, context: CallbackContext, date=None) -> int:
+    """Send the first page of scheduled bookings, optionally for one date"""
+    rows, has_prev, has_next = await run_db(get_appointments_page, date)
+    
+    if not rows and not date:
+        await update.effective_chat.send_message(
+            "Нет активных записей.\n\n"
+            "Вернуться в /start"
+        )
+        return ConversationHandler.END
+    
+    reply_markup = BOOKINGS_MENU_KEYBOARD
+    
+    if not rows:
+        await update.effective_chat.send_message(f"Нет активных записей на {date}.", reply_markup=reply_markup)
+        return ADMIN_VIEW_BOOKINGS
+    
+    text, page_markup = render_bookings_page(rows, has_prev, has_next, date)
+    if page_markup:
+        # A message carries one keyboard: the page gets prev/next, the menu follows
+        await update.effective_chat.send_message(text, reply_markup=page_markup)
+        await update.effective_chat.send_message(
+            "Используйте меню ниже для дальнейших действий:",
+            reply_markup=reply_markup
+        )
+    else:
+        await update.effective_chat.send_message(text, reply_markup=reply_markup)
+    return ADMIN_VIEW_BOOKINGS
+
 async def admin_view_bookings(update: Update, context: CallbackContext) -> int:
     # Handle text input from ReplyKeyboardMarkup
     if update.message:
         admin_choice = update.message.text
         
         if admin_choice == "🔙 Назад в меню админа":
+            context.user_data['awaiting_appointment_id'] = False
+            context.user_data['awaiting_bookings_filter'] = False
+            context.user_data['awaiting_bookings_search'] = False
             return await admin_menu(update, context)
         
         elif admin_choice == "✅ Отметить как выполненную":
@@ -827,12 +2951,80 @@ async def admin_view_bookings(update: Update, context: CallbackContext) -> int:
                 "Введите ID записи, которую нужно отметить как выполненную:"
             )
             context.user_data['awaiting_appointment_id'] = True
+            context.user_data['awaiting_bookings_filter'] = False
+            context.user_data['awaiting_bookings_search'] = False
+            return ADMIN_VIEW_BOOKINGS
+        
+        elif admin_choice == "📅 Фильтр по дате":
+            await update.message.reply_text(
+                "Введите дату в формате ГГГГ-ММ-ДД (или «все», чтобы показать все записи):"
+            )
+            context.user_data['awaiting_bookings_filter'] = True
+            context.user_data['awaiting_appointment_id'] = False
+            context.user_data['awaiting_bookings_search'] = False
             return ADMIN_VIEW_BOOKINGS
+        
+        elif admin_choice == "🔍 Поиск":
+            await update.message.reply_text(SEARCH_HELP)
+            context.user_data['awaiting_bookings_search'] = True
+            context.user_data['awaiting_appointment_id'] = False
+            context.user_data['awaiting_bookings_filter'] = False
+            return ADMIN_VIEW_BOOKINGS
+        
+        elif context.user_data.get('awaiting_appointment_id'):
+            return await admin_mark_completed(update, context)
+        
+        elif context.user_data.get('awaiting_bookings_search'):
+            return await admin_search_bookings(update, context)
+        
+        elif context.user_data.get('awaiting_bookings_filter'):
+            date_text = admin_choice.strip()
+            if date_text.lower() == "все":
+                date = None
+            else:
+                try:
+                    datetime.strptime(date_text, '%Y-%m-%d')
+                except ValueError:
+                    await update.message.reply_text(
+                        "Неверный формат даты. Введите дату в формате ГГГГ-ММ-ДД:"
+                    )
+                    return ADMIN_VIEW_BOOKINGS
+                date = date_text
+            
+            context.user_data['awaiting_bookings_filter'] = False
+            return await send_bookings_page(update, context, date)
     # For backward compatibility, still handle callback queries
     else:
         query = update.callback_query
         await query.answer()
         
+        if query.data.startswith('bk|'):
+            # Prev/next page of the bookings view
+            page = parse_bookings_callback(query.data)
+            rows, has_prev, has_next = await run_db(get_appointments_page, **page)
+            if not rows:
+                await query.edit_message_text("Нет активных записей на этой странице.")
+                return ADMIN_VIEW_BOOKINGS
+            
+            text, page_markup = render_bookings_page(rows, has_prev, has_next, page['date'])
+            await query.edit_message_text(text, reply_markup=page_markup)
+            return ADMIN_VIEW_BOOKINGS
+        
+        if query.data.startswith('done|'):
+            # "Mark completed" button under search results
+            appointment_id = int(query.data.split('|')[1])
+            completed = await run_db(mark_appointment_completed, appointment_id)
+            reminder_scheduler.cancel(appointment_id)
+            if query.message and query.message.reply_markup:
+                buttons = [row for row in query.message.reply_markup.inline_keyboard
+                           if row[0].callback_data != query.data]
+                await query.edit_message_reply_markup(InlineKeyboardMarkup(buttons))
+            await update.effective_chat.send_message(
+                f"Запись #{appointment_id} отмечена как выполненная." if completed
+                else f"Запись #{appointment_id} уже не активна."
+            )
+            return ADMIN_VIEW_BOOKINGS
+        
         if query.data == 'back_to_admin':
             return await admin_menu(update, context)
         
@@ -843,15 +3035,43 @@ async def admin_view_bookings(update: Update, context: CallbackContext) -> int:
             context.user_data['awaiting_appointment_id'] = True
             return ADMIN_VIEW_BOOKINGS
 
+async def admin_search_bookings(update: Update, context: CallbackContext) -> int:
+    text = update.message.text.strip()
+    try:
+        date = datetime.strptime(text, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        date = None
+    if date:
+        rows, _, more = await run_db(get_appointments_page, date, None, None, SEARCH_LIMIT)
+    else:
+        try:
+            rows, more = await run_db(search_appointments, text)
+        except ValueError:
+            await update.message.reply_text(
+                f"Слишком короткий запрос: каждое слово должно быть не короче {SEARCH_MIN_LENGTH} символов."
+            )
+            return ADMIN_VIEW_BOOKINGS
+    
+    context.user_data['awaiting_bookings_search'] = False
+    if not rows:
+        await update.message.reply_text("Ничего не найдено.", reply_markup=BOOKINGS_MENU_KEYBOARD)
+        return ADMIN_VIEW_BOOKINGS
+    
+    text, results_markup = render_search_results(rows, more)
+    await update.message.reply_text(text, reply_markup=results_markup)
+    return ADMIN_VIEW_BOOKINGS
+
 async def admin_mark_completed(update: Update, context: CallbackContext) -> int:
     if 'awaiting_appointment_id' in context.user_data and context.user_data['awaiting_appointment_id']:
         try:
             appointment_id = int(update.message.text.strip())
-            mark_appointment_completed(appointment_id)
+            completed = await run_db(mark_appointment_completed, appointment_id)
+            reminder_scheduler.cancel(appointment_id)
             
             await update.message.reply_text(
-                f"Запись #{appointment_id} отмечена как выполненная.\n\n"
-                "Вернуться в /start"
+                (f"Запись #{appointment_id} отмечена как выполненная.\n\n" if completed
+                 else f"Запись #{appointment_id} не найдена или уже не активна.\n\n")
+                + "Вернуться в /start"
             )
         except ValueError:
             await update.message.reply_text(
@@ -871,13 +3091,27 @@ async def admin_add_dates(update: Update, context: CallbackContext) -> int:
         if admin_choice == "🔙 Назад в меню админа":
             return await admin_menu(update, context)
         
-        # Try to parse the date if it's in YYYY-MM-DD format
+        # A single YYYY-MM-DD date, or a period for bulk adding
         try:
-            # Validate date format
-            date_text = admin_choice
-            datetime.strptime(date_text, '%Y-%m-%d')
-            
-            success = add_working_day(date_text)
+            today = datetime.now().date()
+            dates = parse_days_spec(admin_choice, today)
+        except ValueError:
+            # If not a valid date format, just continue with the calendar
+            dates = None
+        if dates is not None and len(dates) != 1:
+            upcoming = [date for date in dates if date >= today.isoformat()]
+            inserted, skipped = await run_db(add_working_days, upcoming)
+            await update.message.reply_text(
+                f"✅ Добавлено рабочих дней: {inserted}\n"
+                f"Пропущено (уже были рабочими): {skipped}\n"
+                f"Пропущено (в прошлом): {len(dates) - len(upcoming)}\n\n"
+                "Вернуться в /start",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ConversationHandler.END
+        if dates:
+            date_text = dates[0]
+            success = await run_db(add_working_day, date_text)
             
             if success:
                 await update.message.reply_text(
@@ -892,9 +3126,6 @@ async def admin_add_dates(update: Update, context: CallbackContext) -> int:
                     reply_markup=ReplyKeyboardRemove()
                 )
             return ConversationHandler.END
-        except ValueError:
-            # If not a valid date format, just continue with the calendar
-            pass
     
     # Handle callback queries for the calendar
     if update.callback_query:
@@ -928,11 +3159,10 @@ async def admin_add_dates(update: Update, context: CallbackContext) -> int:
                 # Validate date format
                 datetime.strptime(date_text, '%Y-%m-%d')
                 
-                success = add_working_day(date_text)
+                success = await run_db(add_working_day, date_text)
                 
                 # Create a keyboard with back to admin option
-                keyboard = [["🔙 Назад в меню админа"]]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                reply_markup = BACK_TO_ADMIN_KEYBOARD
                 
                 if success:
                     await query.edit_message_text(
@@ -969,8 +3199,22 @@ async def admin_remove_dates(update: Update, context: CallbackContext) -> int:
         if admin_choice == "🔙 Назад в меню админа":
             return await admin_menu(update, context)
         
-        date = admin_choice
-        success = remove_working_day(date)
+        try:
+            dates = parse_days_spec(admin_choice, datetime.now().date())
+        except ValueError:
+            dates = [admin_choice]
+        if len(dates) != 1:
+            removed, skipped = await run_db(remove_working_days, dates)
+            await update.message.reply_text(
+                f"Удалено рабочих дней: {removed}\n"
+                f"Пропущено (не были рабочими): {skipped}\n\n"
+                "Вернуться в /start",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return ConversationHandler.END
+        
+        date = dates[0]
+        success = await run_db(remove_working_day, date)
         
         if success:
             await update.message.reply_text(
@@ -995,7 +3239,7 @@ async def admin_remove_dates(update: Update, context: CallbackContext) -> int:
             return await admin_menu(update, context)
         
         date = query.data
-        success = remove_working_day(date)
+        success = await run_db(remove_working_day, date)
         
         if success:
             await query.edit_message_text(
@@ -1010,6 +3254,34 @@ async def admin_remove_dates(update: Update, context: CallbackContext) -> int:
         
         return ConversationHandler.END
 
+async def admin_export(update: Update, context: CallbackContext) -> int:
+    admin_choice = update.message.text
+    if admin_choice == "🔙 Назад в меню админа":
+        return await admin_menu(update, context)
+    
+    try:
+        first, last, fmt = parse_export_request(admin_choice)
+    except ValueError:
+        await update.message.reply_text("Неверный формат периода.\n\n" + EXPORT_HELP,
+                                        reply_markup=BACK_TO_ADMIN_KEYBOARD)
+        return ADMIN_EXPORT
+    
+    # Spooled to a temporary file on disk, never built up in memory
+    with tempfile.TemporaryFile() as export_file:
+        count = await run_db(write_export, export_file, first, last, fmt)
+        if not count:
+            await update.message.reply_text("За этот период записей нет.", reply_markup=ADMIN_MENU_KEYBOARD)
+            return ADMIN_MENU
+        export_file.seek(0)
+        period = 'all' if not first else f"{first}_{last}"
+        await update.message.reply_document(
+            document=export_file,
+            filename=f"appointments_{period}.{fmt}.gz",
+            caption=f"📤 Выгружено записей: {count}",
+            reply_markup=ADMIN_MENU_KEYBOARD
+        )
+    return ADMIN_MENU
+
 async def cancel(update: Update, context: CallbackContext) -> int:
     await update.message.reply_text(
         "Операция отменена.", 
@@ -1017,60 +3289,288 @@ async def cancel(update: Update, context: CallbackContext) -> int:
     )
     return ConversationHandler.END
 
-def main() -> None:
-    # Initialize database
-    init_db()
+async def on_startup(application: Application) -> None:
+    outbox_dispatcher.start(application.bot)
+    archive_job.start()
+    reminder_scheduler.start()
+
+async def on_shutdown(application: Application) -> None:
+    await reminder_scheduler.stop()
+    await archive_job.stop()
+    await outbox_dispatcher.stop()
+
+def warm_caches():
+    load_barbers()
+    warm_slot_index()
+    load_admin_registry()
+    reload_working_days()
+
+def new_application_builder():
+    builder = Application.builder()
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    return builder.token(BOT_TOKEN)
+
+# Callback data each state accepts, including that of inline keyboards from
+# older versions of the bot. Buttons of other states, e.g. stale ones still in
+# the chat, must not be taken for a service, date, time or confirmation.
+UNBOOK_CALLBACKS = r'^unbook\|\d+$'
+SERVICE_CALLBACKS = '^(' + '|'.join(re.escape(service) for service in SERVICES) + ')$'
+DATE_CALLBACKS = r'^(cancel|\d{4}-\d{2}-\d{2})$'
+TIME_CALLBACKS = r'^(cancel|\d{2}:\d{2})$'
+CONFIRM_CALLBACKS = r'^(confirm|cancel)$'
+ADMIN_MENU_CALLBACKS = r'^(view_bookings|add_dates|remove_dates|exit_admin|back_to_admin)$'
+BOOKINGS_CALLBACKS = r'^(bk\||done\|\d+$|back_to_admin$|mark_completed$)'
+ADD_DATES_CALLBACKS = r'^(back_to_admin$|ignore$|calendar:|date:)'
+REMOVE_DATES_CALLBACKS = r'^(back_to_admin|\d{4}-\d{2}-\d{2})$'
+
+async def answer_ignored_button(update: Update, context: CallbackContext) -> None:
+    # Buttons no state accepts, like "Используйте меню ниже"; stops the spinner
+    await update.callback_query.answer()
+
+def build_application(with_updater=True, request=None):
+    """Create the Application running the booking conversation.
+
+    Without an updater the Application only processes updates put on its
+    update_queue, which is how multi-worker mode feeds its workers; the outbox
+    dispatcher then runs in the front process instead. `request` replaces the
+    HTTP connection pool, e.g. with the in-process fake Bot API of benchmark.py.
+    """
+    builder = (
+        new_application_builder()
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence())
+    )
+    if request is None:
+        builder = builder.connection_pool_size(MAX_CONCURRENT_UPDATES)
+    else:
+        builder = builder.request(request)
+    if with_updater:
+        builder = builder.post_init(on_startup).post_shutdown(on_shutdown)
+    else:
+        builder = builder.updater(None)
+    application = builder.build()
     
-    # Create the Application
-    application = Application.builder().token("7776578154:AAFzZDiIi2yhPVjqNv-7od85ve-UJ1S4ZRU").build()
+    # "Cancel my booking" buttons stay in the chat and may be tapped at any
+    # point of a booking, or after the conversation has ended. Each place gets
+    # a handler of its own, instrumented once under its own state.
+    def unbook_handler():
+        return CallbackQueryHandler(cancel_my_booking, pattern=UNBOOK_CALLBACKS)
     
     # Add conversation handler
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start), unbook_handler()],
         states={
             PROVIDE_CONTACT: [
                 MessageHandler(filters.CONTACT, handle_contact)
             ],
             CHOOSE_SERVICE: [
-                CallbackQueryHandler(choose_service),
+                # A returning client may still send a contact to change their number
+                MessageHandler(filters.CONTACT, handle_contact),
+                unbook_handler(),
+                CallbackQueryHandler(choose_service, pattern=SERVICE_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, choose_service)
             ],
             CHOOSE_DATE: [
-                CallbackQueryHandler(choose_date),
+                unbook_handler(),
+                CallbackQueryHandler(choose_date, pattern=DATE_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, choose_date)
             ],
             CHOOSE_TIME: [
-                CallbackQueryHandler(choose_time),
+                unbook_handler(),
+                CallbackQueryHandler(choose_time, pattern=TIME_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, choose_time)
             ],
             CONFIRM_BOOKING: [
-                CallbackQueryHandler(confirm_booking),
+                unbook_handler(),
+                CallbackQueryHandler(confirm_booking, pattern=CONFIRM_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_booking)
             ],
             ADMIN_MENU: [
-                CallbackQueryHandler(admin_menu),
+                CallbackQueryHandler(admin_menu, pattern=ADMIN_MENU_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_menu)
             ],
             ADMIN_VIEW_BOOKINGS: [
-                CallbackQueryHandler(admin_view_bookings),
+                CallbackQueryHandler(admin_view_bookings, pattern=BOOKINGS_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_view_bookings)
             ],
             ADMIN_ADD_DATES: [
-                CallbackQueryHandler(admin_add_dates),
+                CallbackQueryHandler(admin_add_dates, pattern=ADD_DATES_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_dates)
             ],
             ADMIN_REMOVE_DATES: [
-                CallbackQueryHandler(admin_remove_dates),
+                CallbackQueryHandler(admin_remove_dates, pattern=REMOVE_DATES_CALLBACKS),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, admin_remove_dates)
             ],
+            ADMIN_EXPORT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_export)
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="booking",
+        persistent=True,
     )
+    instrument_conversation(conv_handler)
     
     application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(answer_ignored_button))
+    return application
+
+def run_application(application):
+    """Receive updates for application via polling or webhook, per BOT_MODE"""
+    if BOT_MODE == 'webhook':
+        # Built-in HTTP server; TLS is expected to be terminated by a reverse proxy
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
+
+# Multi-worker mode: the front process receives updates and routes each chat to
+# a fixed worker process. A chat always lands on the same worker, whose
+# PerUserUpdateProcessor keeps its updates in order; all workers share the
+# database. In-memory caches are refreshed when another process commits.
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+CACHE_SYNC_INTERVAL = 1.0  # seconds between checks for other processes' commits
+
+def reload_shared_caches():
+    reload_barbers()
+    warm_slot_index()
+    reload_admin_registry()
+    reload_working_days()
+
+@timed_query
+def refresh_changed_caches(version):
+    """Reload the caches whose keys in cache_versions moved past version:
+    a single date's slots, or one whole cache. Returns the newest version seen."""
+    with db.read() as cursor:
+        cursor.execute(SQL_CHANGED_CACHES, (version,))
+        changed = cursor.fetchall()
+        for key, _ in changed:
+            if key.startswith('slots:'):
+                date = key[len('slots:'):]
+                cursor.execute(SQL_DATE_SLOTS, (date,))
+                slot_index.refresh_date(date, cursor.fetchall())
+    keys = {key for key, _ in changed}
+    if 'barbers' in keys:
+        reload_barbers()
+    if 'admins' in keys:
+        reload_admin_registry()
+    if 'working_days' in keys:
+        reload_working_days()
+    if 'archive' in keys:
+        slot_index.forget_before(datetime.now().strftime('%Y-%m-%d'))
+    return max((key_version for _, key_version in changed), default=version)
+
+async def sync_shared_caches(version):
+    """Refresh the in-memory caches another process has changed since
+    cache version `version`.
+
+    PRAGMA data_version tells cheaply whether anything was committed at all;
+    commits that touch no cache, like persistence flushes and the outbox,
+    then find no changed keys. Caches may lag by up to CACHE_SYNC_INTERVAL;
+    that is safe because a slot is only ever booked through the atomic
+    reserve in save_appointment."""
+    data_version = await run_db(db.data_version)
+    while True:
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        current = await run_db(db.data_version)
+        if current != data_version:
+            data_version = current
+            version = await run_db(refresh_changed_caches, version)
+
+def run_worker(index, updates):
+    """Entry point of a worker process: handles the updates routed to it"""
+    # Ctrl+C reaches the whole process group; the front process stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + index + 1)
+    # Read first: changes made while the caches load are then reloaded again
+    version = cache_version()
+    reload_shared_caches()
+    asyncio.run(serve_worker(index, updates, version))
+
+async def serve_worker(index, updates, version):
+    application = build_application(with_updater=False)
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        sync_task = asyncio.create_task(sync_shared_caches(version))
+        logger.info(f"Worker {index} started")
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        sync_task.cancel()
+        await application.stop()
+
+def run_sharded(workers):
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=run_worker, args=(index, updates), name=f"bot-worker-{index}")
+        for index, updates in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    
+    async def route_update(update: Update, context: CallbackContext) -> None:
+        chat = update.effective_chat or update.effective_user
+        queues[(chat.id if chat else 0) % workers].put(update.to_dict())
+    
+    application = new_application_builder().post_init(on_startup).post_shutdown(on_shutdown).build()
+    application.add_handler(TypeHandler(Update, route_update))
+    try:
+        run_application(application)
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+
+def main() -> None:
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"BOT_MODE must be 'polling' or 'webhook', got {BOT_MODE!r}")
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set when BOT_MODE is 'webhook'")
+    
+    # Initialize database
+    init_db()
+    for name, plan in check_query_plans().items():
+        logger.warning(f"Query for {name} does not use an index: {plan}")
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    # Also seeds admins and barbers, which workers only read
+    warm_caches()
+    
+    if BOT_WORKERS > 1:
+        run_sharded(BOT_WORKERS)
+        return
     
     # Start the Bot
-    application.run_polling()
+    run_application(build_application())
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['--check-plans']:
+        # Query plan regression check: exits non-zero if a hot query scans a table.
+        # Runs on a throwaway database, so the real one is never migrated.
+        with tempfile.TemporaryDirectory() as directory:
+            db = Database(os.path.join(directory, 'plans.db'))
+            init_db()
+            problems = check_query_plans()
+            db.close()
+        for name, plan in problems.items():
+            print(f"{name}: {plan}")
+        sys.exit(1 if problems else 0)
+    if sys.argv[1:] == ['--archive']:
+        # One archival run right now, e.g. from cron when the bot is stopped
+        init_db()
+        stats = archive_old_rows()
+        print(f"Archived {stats['appointments']} appointments and {stats['working_days']} working days")
+        sys.exit(0)
     main()
\ No newline at end of file
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import bot
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh database with empty in-memory caches in front of it"""
+    monkeypatch.setattr(bot, 'db', bot.Database(str(tmp_path / 'test.db')))
+    monkeypatch.setattr(bot, 'slot_index', bot.SlotIndex())
+    monkeypatch.setattr(bot, 'keyboards', bot.KeyboardRegistry())
+    monkeypatch.setattr(bot, 'admin_registry', bot.AdminRegistry())
+    monkeypatch.setattr(bot, 'client_cache', bot.ClientCache())
+    monkeypatch.setattr(bot, 'reminder_scheduler', bot.ReminderScheduler())
+    monkeypatch.setattr(bot, 'outbox_dispatcher', bot.OutboxDispatcher())
+    bot.init_db()
+    bot.warm_caches()
+    yield bot.db
+    bot.db.close()
+
+
+@pytest.fixture
+def chat(database):
+    """Drives the real Application in-process; see benchmark.LoadSimulator"""
+    request = benchmark.FakeBotRequest()
+    return benchmark.LoadSimulator(bot.build_application(with_updater=False, request=request), request)
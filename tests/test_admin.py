@@ -0,0 +1,25 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import bot
+
+
+def test_mark_completed_reports_missing_appointment(chat):
+    date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    bot.add_working_days([date])
+    client_id = bot.save_client(2, 'Client', '+79000000002')
+    appointment_id, _ = bot.save_appointment(client_id, '👦 Детская стрижка', date, '10:00')
+    # Keeps the bookings view open the second time
+    bot.save_appointment(client_id, '👦 Детская стрижка', date, '11:00')
+
+    async def run():
+        async with chat.application:
+            for text in ('/start', None, '📋 Просмотр записей', '✅ Отметить как выполненную', str(appointment_id)):
+                await chat.send(1, 'Admin', text, contact=None if text else bot.ADMIN_PHONE)
+            completed = chat.request.last_text[1]
+            for text in ('/start', None, '📋 Просмотр записей', '✅ Отметить как выполненную', str(appointment_id)):
+                await chat.send(1, 'Admin', text, contact=None if text else bot.ADMIN_PHONE)
+            return completed
+
+    assert asyncio.run(run()).startswith(f'Запись #{appointment_id} отмечена как выполненная.')
+    assert chat.request.last_text[1].startswith(f'Запись #{appointment_id} не найдена или уже не активна.')
@@ -0,0 +1,17 @@
+import bot
+
+
+def test_archival_never_frees_an_appointment_id(database):
+    client_id = bot.save_client(1, 'Client', '+79000000001')
+    with database.write() as cursor:
+        cursor.executemany(
+            "INSERT INTO appointments (client_id, service, date, time, status) VALUES (?, ?, ?, ?, 'completed')",
+            [(client_id, 'Мужская стрижка', '2020-01-01', time) for time in ('10:00', '11:00')]
+        )
+    assert bot.archive_old_rows()['appointments'] == 1
+    with database.read() as cursor:
+        assert cursor.execute('SELECT id FROM appointments').fetchall() == [(2,)]
+    with database.write() as cursor:
+        cursor.execute("INSERT INTO appointments (client_id, service, date, time) VALUES (?, 'x', '2030-01-01', '10:00')",
+                       (client_id,))
+        assert cursor.lastrowid == 3
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+
+def test_workers_reload_only_what_changed(database, monkeypatch):
+    date = (datetime.now() + timedelta(days=2)).strftime('%Y-%m-%d')
+    bot.add_working_days([date])
+    client_id = bot.save_client(1, 'Client', '+79000000001')
+    version = bot.cache_version()
+
+    # Commits that no cache depends on change nothing
+    bot.enqueue_messages([(1, 'text')])
+    assert bot.refresh_changed_caches(version) == version
+
+    bot.save_appointment(client_id, '👦 Детская стрижка', date, '10:00')
+    # The index of another worker, which has not seen the booking
+    monkeypatch.setattr(bot, 'slot_index', bot.SlotIndex())
+    bot.reload_barbers()
+    assert '10:00' in bot.slot_index.free_times(date, 30)
+    reload_working_days = bot.reload_working_days
+    monkeypatch.setattr(bot, 'reload_working_days', lambda: pytest.fail('working days reloaded'))
+    version = bot.refresh_changed_caches(version)
+    assert '10:00' not in bot.slot_index.free_times(date, 30)
+
+    monkeypatch.setattr(bot, 'reload_working_days', reload_working_days)
+    bot.remove_working_days([date])
+    bot.keyboards.load_working_days([date])
+    bot.refresh_changed_caches(version)
+    assert date not in bot.keyboards.working_days
+
+
+def test_versions_keep_increasing_across_archival(database, monkeypatch):
+    client_id = bot.save_client(1, 'Client', '+79000000001')
+    with database.write() as cursor:
+        # Bookings on past dates, made while those dates were current
+        cursor.executemany('INSERT INTO appointments (client_id, service, date, time) VALUES (?, ?, ?, ?)',
+                           [(client_id, 'x', '2020-01-02', '10:00'), (client_id, 'x', '2020-01-03', '10:00')])
+        bot.bump_cache_versions(cursor, ['working_days', bot.slots_key('2020-01-02'), bot.slots_key('2020-01-03')])
+    seen = bot.cache_version()
+    bot.archive_old_rows()
+
+    date = (datetime.now() + timedelta(days=2)).strftime('%Y-%m-%d')
+    bot.add_working_days([date])
+    bot.save_appointment(client_id, '👦 Детская стрижка', date, '10:00')
+    # Caches of another worker, which saw neither change
+    monkeypatch.setattr(bot, 'slot_index', bot.SlotIndex())
+    monkeypatch.setattr(bot, 'keyboards', bot.KeyboardRegistry())
+    bot.reload_barbers()
+    bot.refresh_changed_caches(seen)
+    assert '10:00' not in bot.slot_index.free_times(date, 30)
+    assert date in bot.keyboards.working_days
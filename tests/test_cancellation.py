@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import bot
+
+SERVICE = '👦 Детская стрижка'
+
+
+def unbook_samples():
+    """Recorded cancel_my_booking latencies per conversation state"""
+    return {labels[0]: sum(series[:-1]) for labels, series in bot.HANDLER_LATENCY._series.items()
+            if labels[1] == 'cancel_my_booking'}
+
+
+def test_cancelled_time_can_be_booked_again(chat):
+    date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    bot.add_working_days([date])
+
+    async def book(user_id, name, time):
+        for text in ('/start', None, SERVICE):
+            await chat.send(user_id, name, text, contact=None if text else f'+7900000000{user_id}')
+        dates = [text for text in chat.request.buttons(user_id) if bot.parse_date_button(text) == date]
+        await chat.send(user_id, name, dates[0])
+        await chat.send(user_id, name, time)
+        await chat.send(user_id, name, '✅ Подтвердить')
+        return chat.request.last_text[user_id]
+
+    async def run():
+        async with chat.application:
+            assert (await book(1, 'Anna', '10:00')).startswith('✅')
+            assert '10:00' not in bot.get_available_times(date, SERVICE)
+            await chat.send(1, 'Anna', '/start')
+            await chat.send(1, 'Anna', '📋 Мои записи')
+            unbook = [data for data in chat.request.buttons(1) if data and data.startswith('unbook|')]
+            assert len(unbook) == 1
+
+            # Another client cannot cancel it
+            await chat.send(2, 'Boris', '/start')
+            await chat.send(2, 'Boris', contact='+79000000002')
+            await chat.send(2, 'Boris', callback_data=unbook[0])
+            assert chat.request.last_text[2] == 'Эту запись уже нельзя отменить.'
+            assert '10:00' not in bot.get_available_times(date, SERVICE)
+
+            # The button still works in the middle of a new booking, and is not taken for a date
+            await chat.send(1, 'Anna', SERVICE)
+            before = unbook_samples()
+            await chat.send(1, 'Anna', callback_data=unbook[0])
+            assert chat.request.last_text[1] == f'✅ Запись на {date} 10:00 отменена.'
+            # Timed once, under the state it was tapped in
+            after = unbook_samples()
+            assert {state: after[state] - before.get(state, 0) for state in after
+                    if after[state] != before.get(state, 0)} == {'CHOOSE_DATE': 1}
+            assert '10:00' in bot.get_available_times(date, SERVICE)
+
+            assert (await book(2, 'Boris', '10:00')).startswith('✅')
+            await chat.send(1, 'Anna', callback_data=unbook[0])
+            assert chat.request.last_text[1] == 'Эту запись уже нельзя отменить.'
+
+    asyncio.run(run())
+    with bot.db.read() as cursor:
+        cursor.execute("SELECT c.name, a.status FROM appointments a JOIN clients c ON c.id = a.client_id ORDER BY a.id")
+        assert cursor.fetchall() == [('Anna', 'cancelled'), ('Boris', 'scheduled')]
+
+
+def test_cancel_requires_a_client(database):
+    date = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    bot.add_working_days([date])
+    appointment_id, _ = bot.save_appointment(bot.save_client(1, 'Anna', '+79000000001'), SERVICE, date, '10:00')
+    assert bot.cancel_appointment(appointment_id, None) is None
+    assert '10:00' not in bot.get_available_times(date, SERVICE)
@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import bot
+
+
+def test_failed_commit_is_rolled_back(database):
+    # An unread RETURNING statement makes COMMIT fail
+    with pytest.raises(sqlite3.OperationalError):
+        with database.write() as cursor:
+            cursor.execute("INSERT INTO clients (user_id, name, phone) VALUES (1, 'A', '+1') RETURNING id")
+    assert not database._writer.in_transaction
+    bot.save_client(2, 'B', '+2')
+    other = sqlite3.connect(database.path)
+    try:
+        assert other.execute('SELECT user_id FROM clients').fetchall() == [(2,)]
+    finally:
+        other.close()
+
+
+def test_nested_write_joins_outer_transaction(database):
+    with pytest.raises(RuntimeError):
+        with database.write() as cursor:
+            cursor.execute("INSERT INTO clients (user_id, name, phone) VALUES (1, 'A', '+1')")
+            with database.write() as inner:
+                inner.execute("INSERT INTO clients (user_id, name, phone) VALUES (2, 'B', '+2')")
+            raise RuntimeError
+    with database.read() as cursor:
+        assert cursor.execute('SELECT count(*) FROM clients').fetchone() == (0,)
+
+
+def test_reads_and_handlers_run_while_a_write_is_held(database, chat):
+    holding, release = threading.Event(), threading.Event()
+
+    def hold_write():
+        with database.write():
+            holding.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold_write)
+    holder.start()
+    holding.wait(10)
+
+    async def run():
+        async with chat.application:
+            await chat.application.start()
+            queued = [asyncio.ensure_future(bot.run_db(bot.save_client, user_id, 'Client', f'+7{user_id}'))
+                      for user_id in range(1, 8)]
+            try:
+                working_days = await asyncio.wait_for(bot.run_db(bot.get_working_days), 5)
+                await asyncio.wait_for(chat.send(100, 'Client', '/start'), 5)
+                assert not any(future.done() for future in queued)
+                release.set()
+                await asyncio.wait_for(asyncio.gather(*queued), 5)
+            finally:
+                release.set()
+                await chat.application.stop()
+        return working_days
+
+    try:
+        assert asyncio.run(run()) == []
+        assert 'номером телефона' in chat.request.last_text[100]
+    finally:
+        release.set()
+        holder.join()
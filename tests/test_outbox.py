@@ -0,0 +1,43 @@
+import asyncio
+
+import bot
+
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+
+def test_one_chats_backlog_does_not_hold_up_others(database):
+    bot.enqueue_messages([(1, f'admin {i}') for i in range(60)] + [(2, 'reminder')])
+    dispatcher = bot.OutboxDispatcher()
+    dispatcher.bot = RecordingBot()
+
+    async def run():
+        await dispatcher.drain_once()
+        first_pass = list(dispatcher.bot.sent)
+        # The admin chat is still within its per-chat interval
+        await dispatcher.drain_once()
+        return first_pass
+
+    assert asyncio.run(run()) == [(1, 'admin 0'), (2, 'reminder')]
+    assert dispatcher.bot.sent == [(1, 'admin 0'), (2, 'reminder')]
+    with database.read() as cursor:
+        assert cursor.execute("SELECT min(text), count(*) FROM outbox WHERE status = 'pending'").fetchone() == ('admin 1', 59)
+
+
+def test_chats_are_visited_round_robin(database, monkeypatch):
+    monkeypatch.setattr(bot, 'OUTBOX_BATCH_SIZE', 2)
+    bot.enqueue_messages([(chat_id, f'to {chat_id}') for chat_id in (-5, 1, 2, 3, 4)] + [(1, 'again')])
+    dispatcher = bot.OutboxDispatcher()
+    dispatcher.bot = RecordingBot()
+
+    async def run():
+        for _ in range(3):
+            await dispatcher.drain_once()
+
+    asyncio.run(run())
+    assert dispatcher.bot.sent == [(-5, 'to -5'), (1, 'to 1'), (2, 'to 2'), (3, 'to 3'), (4, 'to 4')]
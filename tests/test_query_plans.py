@@ -0,0 +1,13 @@
+from datetime import date, timedelta
+
+import benchmark
+import bot
+
+
+def test_hot_queries_use_indexes(database):
+    # With a year of bookings and working days and fresh statistics, as in production
+    benchmark.fill_appointments(5000)
+    bot.add_working_days([(date(2030, 1, 1) + timedelta(days=i)).isoformat() for i in range(365)])
+    with database.write() as cursor:
+        cursor.execute('ANALYZE')
+    assert bot.check_query_plans() == {}
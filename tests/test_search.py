@@ -0,0 +1,16 @@
+from datetime import date, timedelta
+
+import bot
+
+
+def test_search_returns_the_earliest_matches(database):
+    # Later clients are booked earlier, so the earliest matches are the last ones found
+    start = date(2030, 1, 1)
+    for i in range(1, 251):
+        client_id = bot.save_client(i, f'Client {i}', f'+7900{i:07d}')
+        with database.write() as cursor:
+            cursor.execute("INSERT INTO appointments (client_id, service, date, time) VALUES (?, 'x', ?, '10:00')",
+                           (client_id, (start + timedelta(days=250 - i)).isoformat()))
+    rows, more = bot.search_appointments('Client')
+    assert [row[1] for row in rows] == [f'Client {i}' for i in range(250, 250 - bot.SEARCH_LIMIT, -1)]
+    assert more
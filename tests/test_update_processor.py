@@ -0,0 +1,51 @@
+import asyncio
+
+from telegram import Update
+
+import bot
+
+
+def message_update(update_id, user_id):
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'hi',
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'}}}, None)
+
+
+def test_queued_updates_of_one_user_do_not_block_others():
+    async def run():
+        processor = bot.PerUserUpdateProcessor(2)
+        release = asyncio.Event()
+        order = []
+
+        async def handle(name, wait):
+            if wait:
+                await release.wait()
+            order.append(name)
+
+        busy = [asyncio.ensure_future(processor.process_update(message_update(i, 1), handle(i, True)))
+                for i in range(5)]
+        await asyncio.wait_for(processor.process_update(message_update(9, 2), handle('other', False)), 1)
+        release.set()
+        await asyncio.gather(*busy)
+        return order
+
+    assert asyncio.run(run()) == ['other', 0, 1, 2, 3, 4]
+
+
+def test_at_most_max_concurrent_updates_run_at_once():
+    async def run():
+        processor = bot.PerUserUpdateProcessor(2)
+        running, peak = 0, 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(message_update(i, i), handle()) for i in range(6)))
+        return peak
+
+    assert asyncio.run(run()) == 2
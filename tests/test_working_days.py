@@ -0,0 +1,16 @@
+from datetime import date
+
+import pytest
+
+import bot
+
+
+def test_parse_days_spec_months():
+    days = bot.parse_days_spec('пн 12 мес', date(2030, 1, 1))
+    assert days[0] == '2030-01-07' and days[-1] == '2030-12-30'
+
+
+@pytest.mark.parametrize('text', ['пн 13 мес', 'пн 99999999999999999999 мес', '0 мес'])
+def test_parse_days_spec_rejects_too_many_months(text):
+    with pytest.raises(ValueError):
+        bot.parse_days_spec(text, date(2030, 1, 1))